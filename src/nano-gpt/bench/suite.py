@@ -0,0 +1,252 @@
+"""
+Reproducible benchmarks of the nanoGPT hot paths, small enough to run on a CPU:
+- forward_backward/<size>: one training forward + backward, at a few model sizes up to
+  config/train_shakespeare_char.py's baby GPT
+- get_batch/<sampler>: DataLoader batches per second from a .bin split, random and epoch order
+- generate/prompt_<n>: KV-cached GPT.generate tokens/sec at a few prompt lengths
+- checkpoint/save, checkpoint/load: CheckpointWriter.save and load_checkpoint + from_state_dict
+- optimizer_step: AdamW from configure_optimizers, one step over the baby GPT's gradients
+
+Every benchmark is timed repeats times after warmup runs, and the median is reported.
+The results go to a JSON file together with the environment (versions, CPU, threads, git
+commit). Given a baseline, the run is compared against it: any benchmark slower by more
+than threshold fails the run, so it can gate an upgrade of torch or of this code.
+
+$ python bench/suite.py --out=bench/baseline.json
+$ python bench/suite.py --baseline=bench/baseline.json --threshold=0.1
+$ python bench/suite.py --only=generate,optimizer_step --threads=4
+$ python bench/suite.py --compare=bench/results.json --baseline=bench/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from contextlib import nullcontext
+import numpy as np
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT) # run from anywhere, e.g. python bench/suite.py
+from model import GPTConfig, GPT
+from dataloader import DataLoader, EpochSampler
+from checkpointing import CheckpointWriter
+from weights import load_checkpoint
+from throughput import Throughput
+
+# -----------------------------------------------------------------------------
+device = 'cpu'
+dtype = 'float32'
+threads = 0 # torch.set_num_threads, pin it for comparable numbers across machines; 0 leaves torch's default
+seed = 1337
+warmup = 1 # untimed runs before every benchmark
+repeats = 5 # timed runs per benchmark, the median is reported
+only = '' # comma separated benchmark names or name prefixes to run, e.g. 'generate,get_batch/epoch'; '' runs all
+out = 'bench/results.json'
+baseline = '' # results JSON of an earlier run to compare against
+threshold = 0.10 # a benchmark regresses if its median is more than this fraction slower than the baseline
+compare = '' # results JSON to compare against the baseline instead of running the suite
+exec(open(os.path.join(ROOT, 'configurator.py')).read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+compute_dtype = 'float32' if device_type == 'cpu' else dtype # no autocast on cpu, so MFU is against the float32 peak
+if threads:
+    torch.set_num_threads(threads)
+
+# model sizes, the last one is config/train_shakespeare_char.py's baby GPT
+sizes = {
+    'tiny': dict(n_layer=2, n_head=2, n_embd=64, block_size=64, batch_size=8),
+    'small': dict(n_layer=4, n_head=4, n_embd=128, block_size=128, batch_size=8),
+    'shakespeare_char': dict(n_layer=6, n_head=6, n_embd=384, block_size=256, batch_size=8),
+}
+vocab_size = 65
+
+def make_model(size):
+    torch.manual_seed(seed)
+    s = sizes[size]
+    config = GPTConfig(n_layer=s['n_layer'], n_head=s['n_head'], n_embd=s['n_embd'],
+                       block_size=s['block_size'], vocab_size=vocab_size, dropout=0.0, bias=False)
+    return GPT(config).to(device)
+
+def sync():
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+
+def timed(fn):
+    # seconds of every timed run of fn, after the warmup runs
+    for _ in range(warmup):
+        fn()
+    sync()
+    runs = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        sync()
+        runs.append(time.perf_counter() - t0)
+    return runs
+
+# -----------------------------------------------------------------------------
+# the benchmarks: each one yields (name, runs, extra metrics computed from the median)
+
+def bench_forward_backward():
+    for size in sizes:
+        model = make_model(size)
+        B, T = sizes[size]['batch_size'], sizes[size]['block_size']
+        x = torch.randint(vocab_size, (B, T), device=device)
+        y = torch.randint(vocab_size, (B, T), device=device)
+        def step():
+            model.zero_grad(set_to_none=True)
+            with ctx:
+                _, loss = model(x, y)
+            loss.backward()
+        runs = timed(step)
+        tp = Throughput(model.config, device, compute_dtype)(B, T, np.median(runs))
+        yield f'forward_backward/{size}', runs, {'tokens_per_sec': tp['tokens/sec'], 'mfu': tp['mfu']}
+
+def bench_get_batch(tmp_dir, n_batches=50):
+    s = sizes['shakespeare_char']
+    B, T = 64, s['block_size'] # train_shakespeare_char.py's batch
+    path = os.path.join(tmp_dir, 'train.bin')
+    np.random.default_rng(seed).integers(vocab_size, size=2**21, dtype=np.uint16).tofile(path)
+    for name in ['random', 'epoch']:
+        sampler = EpochSampler(2**21, T, B, seed=seed) if name == 'epoch' else None
+        loader = DataLoader(path, B, T, device, seed=seed, sampler=sampler)
+        def fetch():
+            for _ in range(n_batches):
+                loader.next()
+        runs = timed(fetch)
+        dt = np.median(runs) / n_batches
+        yield f'get_batch/{name}', runs, {'batches_per_sec': 1 / dt, 'tokens_per_sec': B * T / dt}
+
+@torch.no_grad()
+def bench_generate(prompt_lens=(16, 64, 192), max_new_tokens=32):
+    model = make_model('shakespeare_char')
+    model.eval()
+    for n in prompt_lens:
+        idx = torch.randint(vocab_size, (1, n), device=device)
+        def gen():
+            torch.manual_seed(seed)
+            with ctx:
+                model.generate(idx, max_new_tokens, top_k=10)
+        runs = timed(gen)
+        yield f'generate/prompt_{n}', runs, {'tokens_per_sec': max_new_tokens / np.median(runs)}
+
+def bench_checkpoint(tmp_dir):
+    model = make_model('shakespeare_char')
+    optimizer = model.configure_optimizers(0.1, 1e-3, (0.9, 0.99), device_type)
+    _, loss = model(torch.randint(vocab_size, (2, 16), device=device), torch.randint(vocab_size, (2, 16), device=device))
+    loss.backward()
+    optimizer.step() # so that the optimizer state exists
+    checkpoint = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                  'model_args': {k: getattr(model.config, k) for k in model.config.__dataclass_fields__}, 'iter_num': 0}
+    writer = CheckpointWriter(tmp_dir, async_save=False)
+    runs = timed(lambda: writer.save(checkpoint, 0))
+    path = os.path.join(tmp_dir, 'ckpt.pt')
+    mib = os.path.getsize(path) / 2**20
+    yield 'checkpoint/save', runs, {'mib_per_sec': mib / np.median(runs)}
+    def load():
+        ckpt = load_checkpoint(path)
+        GPT.from_state_dict(GPTConfig(**ckpt['model_args']), ckpt['model'])
+    runs = timed(load)
+    yield 'checkpoint/load', runs, {'mib_per_sec': mib / np.median(runs)}
+
+def bench_optimizer_step():
+    model = make_model('shakespeare_char')
+    optimizer = model.configure_optimizers(0.1, 1e-3, (0.9, 0.99), device_type)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3
+    runs = timed(optimizer.step)
+    yield 'optimizer_step', runs, {'params_per_sec': sum(p.numel() for p in model.parameters()) / np.median(runs)}
+
+# -----------------------------------------------------------------------------
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'device': device,
+        'device_name': torch.cuda.get_device_name(torch.device(device)) if device_type == 'cuda' else '',
+        'dtype': dtype,
+        'git_commit': commit,
+    }
+
+def run():
+    benchmarks = {
+        'forward_backward': lambda tmp: bench_forward_backward(),
+        'get_batch': bench_get_batch,
+        'generate': lambda tmp: bench_generate(),
+        'checkpoint': bench_checkpoint,
+        'optimizer_step': lambda tmp: bench_optimizer_step(),
+    }
+    selected = [s for s in only.split(',') if s]
+    results = {}
+    tmp_dir = tempfile.mkdtemp(prefix='nanogpt-bench-')
+    try:
+        for group, bench in benchmarks.items():
+            if selected and not any(group.startswith(s) or s.startswith(group) for s in selected):
+                continue
+            for name, runs, extra in bench(tmp_dir):
+                if selected and not any(name.startswith(s) for s in selected):
+                    continue
+                results[name] = {'seconds': float(np.median(runs)), 'min': min(runs), 'runs': runs,
+                                 **{k: float(v) for k, v in extra.items()}}
+                metrics = ', '.join(f"{k} {v:,.2f}" for k, v in extra.items())
+                print(f"{name:>28}: {results[name]['seconds']*1000:10.2f}ms median, {min(runs)*1000:10.2f}ms min, {metrics}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+def compare_results(current, base):
+    # print every benchmark of both runs side by side, return the names of the regressions
+    for k in ['torch', 'python', 'numpy', 'processor', 'torch_threads', 'device_name', 'dtype']:
+        if current['env'].get(k) != base['env'].get(k):
+            print(f"note: {k} differs from the baseline: {current['env'].get(k)} vs {base['env'].get(k)}")
+    regressions = []
+    print(f"{'benchmark':>28} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name in sorted(set(current['results']) | set(base['results'])):
+        if name not in current['results'] or name not in base['results']:
+            print(f"{name:>28} only in the {'current run' if name in current['results'] else 'baseline'}")
+            continue
+        old, new = base['results'][name]['seconds'], current['results'][name]['seconds']
+        change = new / old - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:>28} {old*1000:>10.2f}ms {new*1000:>10.2f}ms {change*100:>+7.1f}%{flag}")
+    return regressions
+
+if compare:
+    with open(compare) as f:
+        current = json.load(f)
+else:
+    print(f"benchmarking on {device} ({dtype}), {torch.get_num_threads()} threads, median of {repeats} runs")
+    current = {'env': environment(), 'config': dict(warmup=warmup, repeats=repeats, seed=seed), 'results': run()}
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f"wrote {len(current['results'])} results to {out}")
+
+if baseline:
+    with open(baseline) as f:
+        base = json.load(f)
+    regressions = compare_results(current, base)
+    if regressions:
+        raise SystemExit(f"benchmarks FAILED: {len(regressions)} regressed by more than {threshold*100:.0f}%: {', '.join(regressions)}")
+    print(f"benchmarks OK: nothing regressed by more than {threshold*100:.0f}%")
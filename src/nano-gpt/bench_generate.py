@@ -0,0 +1,219 @@
+"""
+Check and time GPT.generate:
+1) the KV-cached path against the uncached one, and the paged KV cache against the
+   dense one. The same seed must give the same tokens on all paths, token for token.
+2) one left-padded batch of ragged prompts x samples against the sequential loop
+   sample.py used to run, one batch-1 generate call per sample.
+3) speculative decoding with a draft model against plain decoding of the target.
+   Greedy outputs must match exactly; sampled ones are timed for the speedup.
+4) num_samples samples of one long prompt with and without a PrefixCache.
+5) generate_stream past block_size: with stride 1 it must match generate() token for token,
+   with stream_stride it is timed against generate()'s recompute-every-token cropping.
+
+$ python bench_generate.py --device=cpu
+$ python bench_generate.py --init_from=gpt2 --max_new_tokens=200
+$ python bench_generate.py --init_from=gpt2-xl --draft_init_from=gpt2 --device=cpu
+"""
+import os
+import time
+from contextlib import nullcontext
+import torch
+from model import GPTConfig, GPT, KVPool, PagedKVCache, PrefixCache
+from weights import load_checkpoint
+
+# -----------------------------------------------------------------------------
+init_from = 'scratch' # 'scratch' (random baby GPT), 'resume' (from an out_dir) or a gpt2 variant
+out_dir = 'out' # ignored if init_from is not 'resume'
+# baby GPT, used for init_from='scratch'; matches config/train_shakespeare_char.py
+n_layer = 6
+n_head = 6
+n_kv_head = 0 # e.g. 1 or 2 to check the caches with multi-query / grouped-query attention
+n_embd = 384
+block_size = 256
+vocab_size = 65
+# generation
+batch_size = 1
+paged_kv_block = 16 # block size of the paged KV cache
+prompt_len = 16
+max_new_tokens = 300 # > block_size - prompt_len also exercises the cropping path
+num_prompts = 4 # ragged prompts of lengths between 1 and prompt_len, for the batched comparison
+num_samples = 4 # samples per prompt, for the batched comparison
+batch_new_tokens = 100 # tokens generated per sample in the batched comparison
+draft_init_from = 'scratch' # draft model for speculative decoding: 'scratch' (random, n_layer=draft_n_layer) or a gpt2 variant
+draft_n_layer = 2
+num_draft = 4 # tokens proposed per speculative round
+spec_new_tokens = 200 # tokens generated in the speculative comparison
+stream_new_tokens = 600 # tokens generated in the streaming comparison, > block_size to slide the window
+stream_stride = 64 # re-encode the context every this many tokens when streaming
+temperature = 0.8
+top_k = 200
+seed = 1337
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+dtype = 'float32' # parity is checked in float32; bfloat16/float16 may flip near-ties
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+torch.manual_seed(seed)
+if init_from == 'scratch':
+    model = GPT(GPTConfig(n_layer=n_layer, n_head=n_head, n_kv_head=n_kv_head, n_embd=n_embd, block_size=block_size,
+                          vocab_size=vocab_size, dropout=0.0))
+elif init_from == 'resume':
+    checkpoint = load_checkpoint(os.path.join(out_dir, 'ckpt.pt'))
+    model = GPT.from_state_dict(GPTConfig(**checkpoint['model_args']), checkpoint['model'])
+elif init_from.startswith('gpt2'):
+    model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+model.eval()
+model.to(device)
+
+x = torch.randint(model.config.vocab_size, (batch_size, prompt_len), device=device)
+
+def run(use_kv_cache, kv_cache=None):
+    torch.manual_seed(seed)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.time()
+    with torch.no_grad(), ctx:
+        y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=use_kv_cache, kv_cache=kv_cache)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    return y, time.time() - t0
+
+run(True) # warmup
+y_ref, dt_ref = run(False)
+y_kv, dt_kv = run(True)
+n_tokens = batch_size * max_new_tokens
+print(f"uncached: {n_tokens / dt_ref:.2f} tokens/sec ({dt_ref*1000:.0f}ms)")
+print(f"kv cache: {n_tokens / dt_kv:.2f} tokens/sec ({dt_kv*1000:.0f}ms), {dt_ref / dt_kv:.2f}x")
+mismatch = (y_ref != y_kv).nonzero()
+if len(mismatch) != 0:
+    raise SystemExit(f"parity FAILED: first mismatch at (row, position) {tuple(mismatch[0].tolist())}")
+print("parity OK: kv-cached samples match the uncached path token for token")
+kv_pool = KVPool(model.config, block_len=paged_kv_block)
+y_paged, dt_paged = run(True, PagedKVCache(kv_pool, model.config))
+stats = kv_pool.stats()
+print(f"paged kv: {n_tokens / dt_paged:.2f} tokens/sec ({dt_paged*1000:.0f}ms), peak {stats['blocks_peak']} blocks "
+      f"of {paged_kv_block}, fragmentation {stats['fragmentation']*100:.1f}%")
+if not torch.equal(y_kv, y_paged):
+    raise SystemExit("parity FAILED: paged KV cache samples differ from the dense KV cache")
+print("parity OK: paged KV cache samples match the dense KV cache")
+
+# -----------------------------------------------------------------------------
+# batched ragged prompts vs the sequential loop
+lengths = torch.randint(1, prompt_len + 1, (num_prompts,)).tolist()
+prompts = [torch.randint(model.config.vocab_size, (n,)).tolist() for n in lengths]
+batch = [p for p in prompts for _ in range(num_samples)]
+
+def run_sequential(k):
+    ys = []
+    for p in batch:
+        x = torch.tensor(p, dtype=torch.long, device=device)[None, ...]
+        ys.append(model.generate(x, batch_new_tokens, temperature=temperature, top_k=k)[0].tolist())
+    return ys
+
+def run_batched(k):
+    return model.generate(batch, batch_new_tokens, temperature=temperature, top_k=k)
+
+def timed(fn, *args):
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.time()
+    with torch.no_grad(), ctx:
+        out = fn(*args)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    return out, time.time() - t0
+
+n_tokens = len(batch) * batch_new_tokens
+timed(run_batched, top_k) # warmup
+_, dt_seq = timed(run_sequential, top_k)
+_, dt_batch = timed(run_batched, top_k)
+print(f"{num_prompts} prompts (lengths {lengths}) x {num_samples} samples, {batch_new_tokens} new tokens each")
+print(f"sequential: {n_tokens / dt_seq:.2f} tokens/sec ({dt_seq*1000:.0f}ms)")
+print(f"batched:    {n_tokens / dt_batch:.2f} tokens/sec ({dt_batch*1000:.0f}ms), {dt_seq / dt_batch:.2f}x")
+# greedy decoding is deterministic, so padding must not change what each row generates
+ys_seq, _ = timed(run_sequential, 1)
+ys_batch, _ = timed(run_batched, 1)
+n_bad = sum(a != b for a, b in zip(ys_seq, ys_batch))
+if n_bad:
+    raise SystemExit(f"padding FAILED: {n_bad}/{len(batch)} greedy rows differ from their batch-1 decode")
+print("padding OK: greedy batched rows match their batch-1 decode")
+
+# -----------------------------------------------------------------------------
+# speculative decoding vs plain decoding of the target model
+if draft_init_from == 'scratch':
+    draft = GPT(GPTConfig(n_layer=draft_n_layer, n_head=n_head, n_embd=n_embd, block_size=model.config.block_size,
+                          vocab_size=model.config.vocab_size, dropout=0.0))
+else:
+    draft = GPT.from_pretrained(draft_init_from, dict(dropout=0.0))
+draft.eval()
+draft.to(device)
+x = torch.randint(model.config.vocab_size, (1, prompt_len), device=device)
+n_spec = min(spec_new_tokens, model.config.block_size - prompt_len - num_draft) # stay within the context
+
+def run_plain(k):
+    return model.generate(x, n_spec, temperature=temperature, top_k=k)
+
+def run_speculative(k):
+    return model.generate_speculative(x, draft, n_spec, num_draft=num_draft, temperature=temperature, top_k=k)
+
+torch.manual_seed(seed)
+timed(run_speculative, top_k) # warmup
+y_plain, _ = timed(run_plain, 1)
+(y_spec, _), _ = timed(run_speculative, 1)
+if not torch.equal(y_plain, y_spec):
+    raise SystemExit("speculative FAILED: greedy speculative decoding differs from plain greedy decoding")
+print("speculative OK: greedy speculative decoding matches plain greedy decoding")
+_, dt_plain = timed(run_plain, top_k)
+(_, stats), dt_spec = timed(run_speculative, top_k)
+print(f"draft {draft_init_from} proposing {num_draft} tokens per round, {n_spec} new tokens")
+print(f"plain:       {n_spec / dt_plain:.2f} tokens/sec ({dt_plain*1000:.0f}ms)")
+print(f"speculative: {n_spec / dt_spec:.2f} tokens/sec ({dt_spec*1000:.0f}ms), {dt_plain / dt_spec:.2f}x, "
+      f"acceptance rate {stats['accepted'] / max(stats['proposed'], 1) * 100:.1f}%")
+
+# -----------------------------------------------------------------------------
+# shared prompt prefix: num_samples rows of one long prompt, without and with a prefix cache
+prefix_cache = PrefixCache(model.config)
+prompt = torch.randint(model.config.vocab_size, (model.config.block_size // 2,)).tolist()
+
+def run_prefix(k, cache):
+    return model.generate([prompt] * num_samples, batch_new_tokens, temperature=temperature, top_k=k, prefix_cache=cache)
+
+ys_plain, dt_plain = timed(run_prefix, 1, None)
+ys_cold, dt_cold = timed(run_prefix, 1, prefix_cache)
+ys_warm, dt_warm = timed(run_prefix, 1, prefix_cache)
+if not (ys_plain == ys_cold == ys_warm):
+    raise SystemExit("prefix cache FAILED: greedy samples differ with the prefix cache")
+stats = prefix_cache.stats()
+if not stats['token_hit_rate'] > 0:
+    raise SystemExit("prefix cache FAILED: the warm run didn't load anything from the prefix cache")
+print(f"prompt of {len(prompt)} tokens x {num_samples} samples: {dt_plain*1000:.0f}ms without prefix cache, "
+      f"{dt_cold*1000:.0f}ms cold, {dt_warm*1000:.0f}ms warm; token hit rate {stats['token_hit_rate']*100:.1f}%, "
+      f"{stats['bytes']/2**20:.1f}MiB cached")
+print("prefix cache OK: greedy samples match, the warm run hit the cache")
+
+# -----------------------------------------------------------------------------
+# streaming past block_size: sliding the window every stream_stride tokens vs every token
+x = torch.randint(model.config.vocab_size, (1, prompt_len), device=device)
+
+def run_crop():
+    torch.manual_seed(seed)
+    return model.generate(x, stream_new_tokens, temperature=temperature, top_k=top_k)[:, prompt_len:]
+
+def run_stream(stride):
+    torch.manual_seed(seed)
+    return torch.cat(list(model.generate_stream(x, stream_new_tokens, temperature=temperature, top_k=top_k, stride=stride)), dim=1)
+
+y_crop, dt_crop = timed(run_crop)
+y_stream, _ = timed(run_stream, 1)
+if not torch.equal(y_crop, y_stream):
+    raise SystemExit("streaming FAILED: generate_stream with stride 1 differs from generate()")
+print("streaming OK: generate_stream with stride 1 matches generate()")
+_, dt_stream = timed(run_stream, stream_stride)
+print(f"{stream_new_tokens} new tokens, block size {model.config.block_size}")
+print(f"crop every token:          {stream_new_tokens / dt_crop:.2f} tokens/sec ({dt_crop*1000:.0f}ms)")
+print(f"re-encode every {stream_stride:>3} tokens: {stream_new_tokens / dt_stream:.2f} tokens/sec ({dt_stream*1000:.0f}ms), "
+      f"{dt_crop / dt_stream:.2f}x")
@@ -0,0 +1,91 @@
+"""
+Check and time the chunked lm_head + cross-entropy (GPTConfig.loss_chunk_size) against the
+plain one that materializes the full (batch_size, block_size, vocab_size) logits:
+the loss and every parameter gradient must match within tolerance, and on cuda the peak
+memory of a forward + backward is reported for both, i.e. how much room it frees up for
+a larger micro-batch. Throughput and MFU (see throughput.py) are reported for both.
+
+$ python bench_loss.py --device=cpu
+$ python bench_loss.py --n_layer=12 --n_head=12 --n_embd=768 --block_size=1024 --vocab_size=50304 --batch_size=12
+"""
+import time
+from contextlib import nullcontext
+import torch
+from model import GPTConfig, GPT
+from throughput import Throughput
+
+# -----------------------------------------------------------------------------
+n_layer = 6
+n_head = 6
+n_embd = 384
+block_size = 256
+vocab_size = 50304 # the chunked loss matters most for large vocabularies
+batch_size = 8
+loss_chunk_size = 1024
+iters = 5 # timed forward + backward passes per path
+seed = 1337
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+dtype = 'float32' # gradients are compared in float32; bfloat16/float16 only loosely match
+tolerance = 1e-4 # max abs difference allowed in the loss and in any gradient
+mfu_calibrate = False # MFU against this device's measured matmul FLOPS, not its datasheet peak
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+torch.manual_seed(seed)
+model = GPT(GPTConfig(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
+                      vocab_size=vocab_size, dropout=0.0))
+model.to(device)
+x = torch.randint(vocab_size, (batch_size, block_size), device=device)
+y = torch.randint(vocab_size, (batch_size, block_size), device=device)
+y[:, :block_size // 8] = -1 # some ignored positions, as in a masked fine-tuning batch
+
+def step(chunk):
+    model.config.loss_chunk_size = chunk
+    model.zero_grad(set_to_none=True)
+    with ctx:
+        _, loss = model(x, y)
+    loss.backward()
+    return loss.detach()
+
+def run(chunk):
+    step(chunk) # warmup
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.time()
+    for _ in range(iters):
+        loss = step(chunk)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    dt = (time.time() - t0) / iters
+    peak = torch.cuda.max_memory_allocated() if device_type == 'cuda' else None
+    grads = {n: p.grad.clone() for n, p in model.named_parameters()}
+    return loss, grads, dt, peak
+
+loss_ref, grads_ref, dt_ref, peak_ref = run(0)
+loss_chk, grads_chk, dt_chk, peak_chk = run(loss_chunk_size)
+n_tokens = batch_size * block_size
+logits_mib = n_tokens * vocab_size * 4 / 2**20
+print(f"{n_tokens} positions x vocab {vocab_size}: full float32 logits are {logits_mib:.1f}MiB, "
+      f"a chunk of {loss_chunk_size} is {loss_chunk_size * vocab_size * 4 / 2**20:.1f}MiB")
+compute_dtype = 'float32' if device_type == 'cpu' else dtype # no autocast on cpu, see ctx
+throughput = Throughput(model.config, device, compute_dtype, measure_peak=mfu_calibrate)
+print(throughput.describe())
+for name, dt, peak in [('full', dt_ref, peak_ref), ('chunked', dt_chk, peak_chk)]:
+    mem = f", peak memory {peak / 2**20:.1f}MiB" if peak is not None else ""
+    tp = throughput(batch_size, block_size, dt)
+    print(f"{name:>8}: {dt*1000:.1f}ms per forward + backward, {tp['tokens/sec']:.0f} tokens/sec, "
+          f"{tp['samples/sec']:.1f} samples/sec, mfu {tp['mfu']*100:.2f}%{mem}")
+if peak_ref is not None:
+    print(f"peak memory saved: {(peak_ref - peak_chk) / 2**20:.1f}MiB")
+diff = (loss_ref - loss_chk).abs().item()
+worst = max(grads_ref, key=lambda n: (grads_ref[n] - grads_chk[n]).abs().max().item())
+grad_diff = (grads_ref[worst] - grads_chk[worst]).abs().max().item()
+print(f"loss {loss_ref.item():.6f} vs {loss_chk.item():.6f}, max gradient difference {grad_diff:.2e} ({worst})")
+if diff > tolerance or grad_diff > tolerance:
+    raise SystemExit("chunked loss FAILED: loss or gradients differ from the full logits path")
+print("chunked loss OK: loss and gradients match the full logits path")
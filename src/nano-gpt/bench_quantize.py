@@ -0,0 +1,105 @@
+"""
+Quantize a model to int8/int4 weights, report the perplexity delta on a dataset's val split
+and the decoding tokens/sec against the float model, and optionally save the quantized
+model for sample.py --init_from=quantized. Fails if the quantized model decodes slower.
+
+$ python bench_quantize.py --init_from=gpt2-xl --dataset=shakespeare --device=cpu
+$ python bench_quantize.py --out_dir=out-shakespeare-char --dataset=shakespeare_char --mode=int4 --save=True
+"""
+import os
+import time
+import math
+from contextlib import nullcontext
+import numpy as np
+import torch
+from model import GPTConfig, GPT
+from weights import load_checkpoint
+from quantize import quantize_model, save_quantized
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out'
+mode = 'int8' # 'int8' or 'int4'
+group_size = 128 # int4 only
+save = False # write the quantized model to out_dir/ckpt_quant.pt
+# perplexity
+dataset = 'shakespeare' # its val.bin must use the model's tokenizer
+eval_iters = 20
+batch_size = 8
+block_size = 256
+# decoding speed
+max_new_tokens = 100
+seed = 1337
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float32'
+compile = False # compile the forward of both models for the perplexity eval
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+checkpoint = {}
+if init_from == 'resume':
+    checkpoint = load_checkpoint(os.path.join(out_dir, 'ckpt.pt'))
+    model = GPT.from_state_dict(GPTConfig(**checkpoint['model_args']), checkpoint['model'])
+elif init_from.startswith('gpt2'):
+    model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+model.eval()
+block_size = min(block_size, model.config.block_size)
+
+# a fixed set of val windows, so that both models see the same tokens
+data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint16, mode='r')
+g = torch.Generator().manual_seed(seed)
+ix = torch.randint(len(data) - block_size, (eval_iters, batch_size), generator=g)
+
+@torch.no_grad()
+def perplexity(m):
+    losses = []
+    for k in range(eval_iters):
+        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix[k]]).to(device)
+        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix[k]]).to(device)
+        with ctx:
+            _, loss = m(x, y)
+        losses.append(loss.item())
+    return math.exp(sum(losses) / len(losses))
+
+@torch.no_grad()
+def tokens_per_sec(m):
+    x = torch.zeros((1, 1), dtype=torch.long, device=device)
+    with ctx:
+        m.generate(x, 10) # warmup
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.time()
+        m.generate(x, max_new_tokens)
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
+    return max_new_tokens / (time.time() - t0)
+
+def weight_bytes(m):
+    return sum(t.numel() * t.element_size() for t in list(m.parameters()) + list(m.buffers()))
+
+def report(name, m):
+    fwd = torch.compile(m) if compile else m
+    ppl, tps = perplexity(fwd), tokens_per_sec(m)
+    print(f"{name:>8}: {weight_bytes(m)/2**20:8.1f}MiB, val perplexity {ppl:.4f}, {tps:.2f} tokens/sec")
+    return ppl, tps
+
+torch.manual_seed(seed)
+model.to(device)
+ppl_float, tps_float = report('float', model)
+model.cpu()
+model = quantize_model(model, mode, group_size)
+model.to(device)
+ppl_quant, tps_quant = report(mode, model)
+print(f"perplexity delta {ppl_quant - ppl_float:+.4f} ({(ppl_quant / ppl_float - 1) * 100:+.2f}%), "
+      f"decoding {tps_quant / tps_float:.2f}x")
+if save:
+    path = os.path.join(out_dir, 'ckpt_quant.pt')
+    print(f"saving quantized model to {path}")
+    os.makedirs(out_dir, exist_ok=True)
+    save_quantized(model, path, checkpoint.get('config'))
+if tps_quant < tps_float:
+    raise SystemExit(f"quantize FAILED: {mode} decodes at {tps_quant:.2f} tokens/sec, slower than float's {tps_float:.2f}")
@@ -0,0 +1,99 @@
+"""
+Microbenchmark the per-step cost of sampling a token from a batch of logits: the full
+vocabulary recipe generate() used to run (temperature, topk, mask fill, softmax and
+multinomial over all vocab_size logits) against sampling.sample, which only touches the
+candidates. Also checks that sampling.distribution matches the filters applied one by one
+over the full vocabulary, for top-k, top-p, min-p and a batch with per-row parameters.
+
+$ python bench_sampling.py --device=cpu
+$ python bench_sampling.py --batch_sizes="[1,64,256]" --top_k=50
+"""
+import time
+import torch
+from torch.nn import functional as F
+from sampling import sample, distribution, real_vocab_size
+
+# -----------------------------------------------------------------------------
+vocab_size = 50304 # gpt2's 50257 tokens padded for efficiency, as in train.py
+batch_sizes = [1, 8, 32]
+temperature = 0.8
+top_k = 200
+top_p = 0.9
+min_p = 0.05
+iters = 200
+seed = 1337
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+torch.manual_seed(seed)
+
+def reference(logits, temperature, top_k):
+    # the sampling step generate() used to run
+    logits = logits / temperature
+    v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+    logits[logits < v[:, [-1]]] = -float('Inf')
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+def reference_distribution(row, temperature, top_k=None, top_p=None, min_p=None):
+    # the filters applied one by one to the full vocabulary distribution of one row of logits
+    probs = F.softmax(row / temperature, dim=-1)
+    if top_k is not None:
+        probs[probs < torch.topk(probs, top_k).values[-1]] = 0
+        probs = probs / probs.sum()
+    if top_p is not None:
+        # the fewest most likely tokens whose probabilities add up to top_p
+        sorted_probs, order = torch.sort(probs, descending=True)
+        probs[order[sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p]] = 0
+    if min_p is not None:
+        probs[probs < min_p * probs.max()] = 0
+    return probs / probs.sum()
+
+def timed(fn, *args):
+    fn(*args) # warmup
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(iters):
+        fn(*args)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - t0) / iters
+
+# same distribution: the reference has no notion of padded slots, so compare on the real tokens only
+n_vocab = real_vocab_size(vocab_size)
+logits = torch.randn(4, n_vocab, device=device) * 3
+checks = {
+    # name: (temperature, top_k, top_p, min_p), one value for the batch or one per row
+    'top-k': (temperature, top_k, None, None),
+    'top-p': (temperature, None, top_p, None),
+    'top-k+p': (temperature, top_k, top_p, None),
+    'min-p': (temperature, None, None, min_p),
+    'per-row': ([temperature, 1.0, 0.5, 1.2], [top_k, None, 10, max(top_k // 2, 1)], [None, top_p, None, 0.5], [None, None, min_p, 0.01]),
+}
+for name, params in checks.items():
+    rows = [[v[i] if isinstance(v, list) else v for v in params] for i in range(logits.size(0))]
+    ref = torch.stack([reference_distribution(row, *p) for row, p in zip(logits, rows)])
+    diff = (ref - distribution(logits, *params)).abs().max().item()
+    if diff > 1e-5:
+        raise SystemExit(f"sampling FAILED: {name} distribution differs from the reference by {diff:.2e}")
+    print(f"distribution OK: {name} matches the full vocabulary reference (max difference {diff:.2e})")
+
+print(f"vocab {vocab_size} ({n_vocab} real tokens), per sampling step:")
+print(f"{'batch':>6} {'reference':>12} {'top-k':>12} {'top-k+p':>12} {'top-p':>12} {'min-p':>12} {'per-row':>12}")
+for B in batch_sizes:
+    logits = torch.randn(B, vocab_size, device=device) * 3
+    t_ref = timed(lambda: reference(logits.clone(), temperature, top_k))
+    t_k = timed(lambda: sample(logits, temperature, top_k, vocab_size=n_vocab))
+    t_kp = timed(lambda: sample(logits, temperature, top_k, top_p, vocab_size=n_vocab))
+    t_p = timed(lambda: sample(logits, temperature, top_p=top_p, vocab_size=n_vocab))
+    t_m = timed(lambda: sample(logits, temperature, min_p=min_p, vocab_size=n_vocab))
+    # a served batch: every row with its own parameters
+    temps = [temperature + 0.1 * (i % 3) for i in range(B)]
+    ks = [top_k // (1 + i % 4) for i in range(B)]
+    ps = [top_p if i % 2 else None for i in range(B)]
+    t_rows = timed(lambda: sample(logits, temps, ks, ps, vocab_size=n_vocab))
+    print(f"{B:>6} " + " ".join(f"{t*1e6:>10.0f}us" for t in [t_ref, t_k, t_kp, t_p, t_m, t_rows]) +
+          f"   top-k {t_ref / t_k:.2f}x")
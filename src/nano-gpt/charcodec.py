@@ -0,0 +1,71 @@
+"""
+Character-level codec, the one of the meta.pkl that data/shakespeare_char/prepare.py writes.
+Encoding reinterprets the text as UTF-32 code points and maps them to token ids through a
+lookup table indexed by code point. Decoding indexes an array of code points with the ids.
+Both are a few numpy ops per call, not a python dict lookup per character, so that corpora
+of hundreds of MB encode in seconds. encode_file streams a file through it in chunks.
+"""
+
+import numpy as np
+
+
+class CharCodec:
+
+    def __init__(self, chars):
+        # chars: the vocabulary, chars[i] is the character of token id i
+        self.chars = list(chars)
+        self.vocab_size = len(self.chars)
+        self.dtype = np.uint16 if self.vocab_size <= 2**16 else np.uint32
+        self.code_points = np.array([ord(c) for c in self.chars], dtype=np.uint32)  # id -> code point
+        self.lut = np.full(int(self.code_points.max()) + 1 if self.vocab_size else 0, -1, dtype=np.int64)
+        self.lut[self.code_points] = np.arange(self.vocab_size)  # code point -> id, -1 if not in the vocabulary
+
+    @classmethod
+    def from_meta(cls, meta):
+        # meta: the dict pickled in meta.pkl
+        return cls(meta['itos'][i] for i in range(meta['vocab_size']))
+
+    def meta(self):
+        # dtype: of the token ids in the .bin files, e.g. 'uint16'
+        return {'vocab_size': self.vocab_size, 'itos': dict(enumerate(self.chars)),
+                'stoi': {c: i for i, c in enumerate(self.chars)}, 'dtype': np.dtype(self.dtype).name}
+
+    def encode(self, s):
+        """ token ids of the string s, as a numpy array of self.dtype """
+        cp = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+        ids = self.lut[np.minimum(cp, len(self.lut) - 1)]
+        unknown = (cp >= len(self.lut)) | (ids < 0)
+        if unknown.any():
+            bad = sorted({chr(c) for c in cp[unknown][:100]})
+            raise KeyError(f"characters not in the vocabulary: {bad!r}")
+        return ids.astype(self.dtype)
+
+    def decode(self, ids):
+        """ the string of a sequence of token ids (a list, numpy array or tensor) """
+        return self.code_points[np.asarray(ids, dtype=np.int64)].tobytes().decode('utf-32-le')
+
+    def encode_file(self, path, chunk_chars=2**24):
+        """ token ids of the text file at path, yielded chunk_chars characters at a time """
+        with open(path, 'r', encoding='utf-8') as f:
+            while True:
+                chunk = f.read(chunk_chars)
+                if not chunk:
+                    return
+                yield self.encode(chunk)
+
+
+def scan_file(path, chunk_chars=2**24):
+    """
+    (codec, n_chars) for the text file at path: a codec of every character that occurs in
+    it, in sorted order, and its length in characters. Streams the file in chunks.
+    """
+    code_points, n_chars = np.zeros(0, dtype=np.uint32), 0
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(chunk_chars)
+            if not chunk:
+                break
+            n_chars += len(chunk)
+            cp = np.frombuffer(chunk.encode('utf-32-le'), dtype=np.uint32)
+            code_points = np.union1d(code_points, np.unique(cp))
+    return CharCodec(chr(c) for c in code_points), n_chars
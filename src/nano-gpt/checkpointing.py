@@ -0,0 +1,187 @@
+"""
+Checkpoint writing that doesn't stall training and never leaves a torn checkpoint behind.
+CheckpointWriter.save snapshots the state to CPU memory, which is the only part the
+training loop waits for. The serialization runs on a background thread, into a temporary
+file that is fsynced and renamed into place, so a crash mid-write leaves the previous
+checkpoint intact.
+
+Layout in out_dir: ckpt.pt is always the latest complete checkpoint, as sample.py and
+train.py --init_from=resume expect. With keep_last > 1 it is a hard link to the newest of
+the ckpt-<iter>.pt files that are kept. With shard=True every DDP rank writes only its
+share of the model and optimizer tensors, to ckpt-<iter>.shard<rank>.pt. Rank 0's shard
+also carries everything else and is the one ckpt.pt points to. A sharded checkpoint is
+complete once every rank has written its shard: the ranks agree on that before rank 0
+moves ckpt.pt to it, and only prune older shards once ckpt.pt has moved, so ckpt.pt
+always points to a step with all of its shards. weights.load_checkpoint puts the shards
+back together.
+"""
+
+import os
+import glob
+import time
+import threading
+
+import torch
+import torch.distributed as dist
+
+
+def shard_path(out_dir, stem, rank):
+    return os.path.join(out_dir, f'{stem}.shard{rank}.pt')
+
+
+def _to_cpu(obj, memo=None):
+    # a copy of obj with every tensor copied to the CPU, safe from the in-place updates that
+    # follow. tensors that appear twice (the tied wte / lm_head weight) are copied once
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        if id(obj) not in memo:
+            memo[id(obj)] = obj.detach().to('cpu', copy=True)
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v, memo) for v in obj)
+    return obj
+
+
+def _nbytes(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    return 0
+
+
+def _owners(sizes, world_size):
+    # deterministically spread items of the given sizes over world_size ranks, biggest first
+    # onto the least loaded rank, so every rank writes about the same number of bytes
+    load, owner = [0] * world_size, {}
+    for k in sorted(sizes, key=lambda k: (-sizes[k], str(k))):
+        r = min(range(world_size), key=lambda r: load[r])
+        owner[k] = r
+        load[r] += sizes[k]
+    return owner
+
+
+def _atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _link_latest(src, dst):
+    # point dst at src atomically, without writing the data a second time
+    tmp_path = dst + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.link(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter:
+
+    def __init__(self, out_dir, keep_last=1, shard=False, rank=0, world_size=1, async_save=True):
+        self.out_dir = out_dir
+        self.keep_last = keep_last
+        self.shard = shard and world_size > 1
+        self.rank = rank
+        self.world_size = world_size
+        self.async_save = async_save
+        self.thread = None
+        self.error = None
+        # the ranks agree on sharded saves over their own gloo group: the writes run on a
+        # background thread, and must not interleave with the training loop's collectives
+        self.group = dist.new_group(backend='gloo') if self.shard else None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def save(self, checkpoint, iter_num):
+        """
+        Write checkpoint (a dict with 'model' and 'optimizer' state_dicts and anything else)
+        as the one of iteration iter_num. With shard=True every rank has to call this, and
+        without it only rank 0 should. Returns once the snapshot is on the CPU.
+        """
+        self.wait()  # one write in flight at a time
+        t0 = time.time()
+        if self.shard:
+            checkpoint = self._my_shard(checkpoint)
+        elif self.rank != 0:
+            return
+        snapshot = _to_cpu(checkpoint)
+        t_snapshot = time.time() - t0
+        if self.async_save:
+            self.thread = threading.Thread(target=self._write, args=(snapshot, iter_num, t_snapshot), daemon=True)
+            self.thread.start()
+        else:
+            self._write(snapshot, iter_num, t_snapshot)
+
+    def wait(self):
+        # block until the checkpoint in flight, if any, is on disk
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing the last checkpoint failed") from error
+
+    def _my_shard(self, checkpoint):
+        # this rank's share of the model and optimizer tensors. rank 0 also keeps all the rest
+        model, optimizer = checkpoint['model'], checkpoint['optimizer']
+        model_owner = _owners({k: _nbytes(v) for k, v in model.items()}, self.world_size)
+        state_owner = _owners({k: _nbytes(v) for k, v in optimizer['state'].items()}, self.world_size)
+        shard = dict(checkpoint) if self.rank == 0 else {}
+        shard['model'] = {k: v for k, v in model.items() if model_owner[k] == self.rank}
+        shard['optimizer'] = dict(optimizer, state={k: v for k, v in optimizer['state'].items() if state_owner[k] == self.rank})
+        shard['num_shards'] = self.world_size
+        return shard
+
+    def _write(self, snapshot, iter_num, t_snapshot):
+        try:
+            t0 = time.time()
+            stem = f'ckpt-{iter_num:07d}'
+            latest = os.path.join(self.out_dir, 'ckpt.pt')
+            if self.shard:
+                snapshot['shard_stem'] = stem
+                path = shard_path(self.out_dir, stem, self.rank)
+                error = None
+                try:
+                    _atomic_save(snapshot, path)
+                except Exception as e:
+                    error = e
+                if not self._agree(error is None):
+                    raise RuntimeError(f"not every rank wrote its shard of {stem}, ckpt.pt is left as it was") from error
+                if self.rank == 0:
+                    try:
+                        _link_latest(path, latest)
+                    except Exception as e:
+                        error = e
+                # ckpt.pt has moved on before anyone prunes the shards it pointed to
+                if not self._agree(error is None):
+                    raise RuntimeError(f"pointing ckpt.pt at {stem} failed, the older shards are kept") from error
+            elif self.keep_last > 1:
+                path = os.path.join(self.out_dir, stem + '.pt')
+                _atomic_save(snapshot, path)
+                _link_latest(path, latest)
+            else:
+                _atomic_save(snapshot, latest)
+            self._prune()
+            if self.rank == 0:
+                print(f"checkpoint of iter {iter_num} written: {t_snapshot*1000:.0f}ms to snapshot, "
+                      f"{time.time() - t0:.2f}s to write")
+        except Exception as e:
+            self.error = e
+
+    def _agree(self, ok):
+        # True on every rank if ok is True on every rank
+        flag = torch.tensor([int(ok)])
+        dist.all_reduce(flag, op=dist.ReduceOp.MIN, group=self.group)
+        return bool(flag.item())
+
+    def _prune(self):
+        # drop all but the newest keep_last checkpoints of this rank (ckpt.pt may still link to one)
+        pattern = f'ckpt-*.shard{self.rank}.pt' if self.shard else 'ckpt-*[0-9].pt'
+        paths = sorted(glob.glob(os.path.join(self.out_dir, pattern)))
+        for path in paths[:-max(self.keep_last, 1)]:
+            os.remove(path)
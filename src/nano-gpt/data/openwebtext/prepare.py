@@ -1,81 +1,234 @@
-# saves the openwebtext dataset to a binary file for training. following was helpful:
+# saves the openwebtext dataset as token shards plus a manifest.json for training (see shards.py).
+# documents are streamed from the huggingface hub (or read from a local corpus of .txt files) in
+# batches and tokenized by a pool of processes, each of which appends the tokens of its batches to
+# its own train / val shard files as it goes. nothing is cached or materialized in between.
+# every finished batch is recorded in a journal, so an interrupted run picks up where it stopped:
+# $ python data/openwebtext/prepare.py
+# $ python data/openwebtext/prepare.py --input_dir=path/to/txt/files --out_dir=/tmp/owt_test
+# following was helpful:
 # https://github.com/HazyResearch/flash-attention/blob/main/training/src/datamodules/language_modeling_hf.py
 
 import os
-from tqdm import tqdm
+import sys
+import glob
+import json
+import time
+import multiprocessing as mp
+from collections import deque
+from itertools import chain
 import numpy as np
 import tiktoken
-from datasets import load_dataset # huggingface datasets
 
-# number of workers in .map() call
-# good number to use is ~order number of cpu cores // 2
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..')) # for shards.py and configurator.py
+from shards import write_manifest
+
+# -----------------------------------------------------------------------------
+# number of tokenizer processes, a good number to use is ~order number of cpu cores // 2
 num_proc = 8
+batch_docs = 1024 # documents per batch handed to a worker
+encode_threads = 1 # tiktoken threads per worker, for encode_ordinary_batch
+shard_tokens = 2**27 # a worker starts a new shard once its current one holds this many tokens
+val_every = 2000 # every val_every-th document goes to val, ~0.05% as before (about 4000 documents)
+input_dir = '' # '' streams openwebtext from the hub, else every .txt file below it is one document
+out_dir = os.path.dirname(os.path.abspath(__file__))
+log_interval = 10.0 # seconds
+exec(open(os.path.join(os.path.dirname(__file__), '..', '..', 'configurator.py')).read())
+# -----------------------------------------------------------------------------
 
-# number of workers in load_dataset() call
-# best number might be different from num_proc above as it also depends on NW speed.
-# it is better than 1 usually though
-num_proc_load_dataset = num_proc
+dtype = np.uint16 # (can do since enc.max_token_value == 50256 is < 2**16)
+splits = ['train', 'val']
 
-enc = tiktoken.get_encoding("gpt2")
+def documents():
+    # the text of every document, in a fixed order so that a resumed run sees the same batches
+    if input_dir:
+        for path in sorted(glob.glob(os.path.join(input_dir, '**', '*.txt'), recursive=True)):
+            with open(path, encoding='utf-8') as f:
+                yield f.read()
+    else:
+        from datasets import load_dataset # huggingface datasets
+        # streaming: documents are downloaded as they are read, instead of into a 54GB cache first
+        for example in load_dataset("openwebtext", split='train', streaming=True):
+            yield example['text']
 
-if __name__ == '__main__':
-    # takes 54GB in huggingface .cache dir, about 8M documents (8,013,769)
-    dataset = load_dataset("openwebtext", num_proc=num_proc_load_dataset)
-
-    # owt by default only contains the 'train' split, so create a test split
-    split_dataset = dataset["train"].train_test_split(test_size=0.0005, seed=2357, shuffle=True)
-    split_dataset['val'] = split_dataset.pop('test') # rename the test split to val
-
-    # this results in:
-    # >>> split_dataset
-    # DatasetDict({
-    #     train: Dataset({
-    #         features: ['text'],
-    #         num_rows: 8009762
-    #     })
-    #     val: Dataset({
-    #         features: ['text'],
-    #         num_rows: 4007
-    #     })
-    # })
-
-    # we now want to tokenize the dataset. first define the encoding function (gpt2 bpe)
-    def process(example):
-        ids = enc.encode_ordinary(example['text']) # encode_ordinary ignores any special tokens
-        ids.append(enc.eot_token) # add the end of text token, e.g. 50256 for gpt2 bpe
+def batches():
+    batch = []
+    for doc in documents():
+        batch.append(doc)
+        if len(batch) == batch_docs:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def shard_name(split, worker, index):
+    return f'{split}-w{worker:03d}-{index:05d}.bin'
+
+# -----------------------------------------------------------------------------
+# the workers. each one owns the shard files with its worker id in the name and appends to the
+# last of them, so no two processes ever write to the same file
+
+worker = None
+
+class Worker:
+
+    def __init__(self, worker_id, state):
+        self.id = worker_id
+        self.enc = tiktoken.get_encoding("gpt2")
+        self.files = {}
+        self.state = {} # split -> [shard index, tokens in the shard]
+        for split in splits:
+            index, n = state.get(split, (0, 0))
+            self.state[split] = [index, n]
+            self.files[split] = self._open(split, truncate_to=n)
+
+    def _open(self, split, truncate_to=0):
+        # the current shard, cut back to what the journal knows of: a batch that was written but
+        # not journaled before an interruption is tokenized again
+        path = os.path.join(out_dir, shard_name(split, self.id, self.state[split][0]))
+        f = open(path, 'ab')
+        f.truncate(truncate_to * np.dtype(dtype).itemsize)
+        return f
+
+    def process(self, batch_idx, docs):
+        t0 = time.time()
+        # encode_ordinary ignores any special tokens. then append the end of text token, e.g. 50256 for gpt2 bpe
         # note: I think eot should be prepended not appended... hmm. it's called "eot" though...
-        out = {'ids': ids, 'len': len(ids)}
-        return out
-
-    # tokenize the dataset
-    tokenized = split_dataset.map(
-        process,
-        remove_columns=['text'],
-        desc="tokenizing the splits",
-        num_proc=num_proc,
-    )
-
-    # concatenate all the ids in each dataset into one large file we can use for training
-    for split, dset in tokenized.items():
-        arr_len = np.sum(dset['len'], dtype=np.uint64)
-        filename = os.path.join(os.path.dirname(__file__), f'{split}.bin')
-        dtype = np.uint16 # (can do since enc.max_token_value == 50256 is < 2**16)
-        arr = np.memmap(filename, dtype=dtype, mode='w+', shape=(arr_len,))
-        total_batches = 1024
-
-        idx = 0
-        for batch_idx in tqdm(range(total_batches), desc=f'writing {filename}'):
-            # Batch together samples for faster write
-            batch = dset.shard(num_shards=total_batches, index=batch_idx, contiguous=True).with_format('numpy')
-            arr_batch = np.concatenate(batch['ids'])
-            # Write into mmap
-            arr[idx : idx + len(arr_batch)] = arr_batch
-            idx += len(arr_batch)
-        arr.flush()
-
-    # train.bin is ~17GB, val.bin ~8.5MB
+        ids = self.enc.encode_ordinary_batch(docs, num_threads=encode_threads)
+        out = {split: [] for split in splits}
+        for i, doc_ids in enumerate(ids):
+            doc_ids.append(self.enc.eot_token)
+            out['val' if (batch_idx * batch_docs + i) % val_every == 0 else 'train'].append(doc_ids)
+        t1 = time.time()
+        record = {'batch': batch_idx, 'worker': self.id, 'docs': len(docs),
+                  'encode_time': t1 - t0, 'tokens': 0}
+        for split in splits:
+            if self.state[split][1] >= shard_tokens:
+                self.files[split].close()
+                self.state[split] = [self.state[split][0] + 1, 0]
+                self.files[split] = self._open(split)
+            n = sum(len(doc_ids) for doc_ids in out[split])
+            arr = np.fromiter(chain.from_iterable(out[split]), dtype=dtype, count=n)
+            f = self.files[split]
+            f.write(arr.tobytes())
+            f.flush()
+            os.fsync(f.fileno()) # on disk before the journal says so
+            self.state[split][1] += len(arr)
+            record[split] = list(self.state[split])
+            record['tokens'] += len(arr)
+        record['write_time'] = time.time() - t1
+        return record
+
+def init_worker(ids, states):
+    global worker
+    worker_id = ids.get()
+    worker = Worker(worker_id, states.get(worker_id, {}))
+
+def process(batch_idx, docs):
+    return worker.process(batch_idx, docs)
+
+# -----------------------------------------------------------------------------
+
+def read_journal(path):
+    # the records of the batches finished so far, skipping a last line torn by an interruption
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return records
+
+def shard_states(records):
+    # worker -> split -> (shard index, tokens): where every worker's shards stand after records
+    states = {}
+    for r in records:
+        for split in splits:
+            s = states.setdefault(r['worker'], {})
+            s[split] = max(s.get(split, (0, 0)), tuple(r[split]))
+    return states
+
+if __name__ == '__main__':
+    os.makedirs(out_dir, exist_ok=True)
+    journal_path = os.path.join(out_dir, 'prepare.journal.jsonl')
+    records = read_journal(journal_path)
+    done = {r['batch'] for r in records}
+    if records:
+        print(f"resuming: {len(done)} batches, {sum(r['docs'] for r in records):,} documents done already")
+    # a clean journal: rewrite it without a torn last line, if any
+    with open(journal_path, 'w') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+    journal = open(journal_path, 'a')
+
+    ids = mp.Queue()
+    for i in range(num_proc):
+        ids.put(i)
+    pool = mp.Pool(num_proc, initializer=init_worker, initargs=(ids, shard_states(records)))
+    pending = deque()
+    stats = dict(docs=0, tokens=0, read_time=0.0, encode_time=0.0, write_time=0.0)
+    t_start = t_log = time.time()
+
+    def finish(result):
+        r = result.get()
+        journal.write(json.dumps(r) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+        records.append(r)
+        for k in ['docs', 'tokens', 'encode_time', 'write_time']:
+            stats[k] += r[k]
+
+    def log():
+        # per stage throughput: reading is done by this process, encoding and writing by every
+        # worker in parallel (so those are per worker), overall is the end to end rate of this run
+        elapsed = time.time() - t_start
+        busy = max(stats['encode_time'] + stats['write_time'], 1e-9)
+        print(f"{stats['docs']:,} docs, {stats['tokens']:,} tokens | "
+              f"read {stats['docs'] / max(stats['read_time'], 1e-9):,.0f} docs/s | "
+              f"encode {stats['docs'] / max(stats['encode_time'], 1e-9):,.0f} docs/s, "
+              f"{stats['tokens'] / max(stats['encode_time'], 1e-9):,.0f} tokens/s per worker | "
+              f"write {stats['tokens'] / max(stats['write_time'], 1e-9):,.0f} tokens/s per worker | "
+              f"overall {stats['docs'] / elapsed:,.0f} docs/s, {stats['tokens'] / elapsed:,.0f} tokens/s, "
+              f"workers {100 * busy / (elapsed * num_proc):.0f}% busy")
+
+    t0 = time.time()
+    for batch_idx, docs in enumerate(batches()):
+        stats['read_time'] += time.time() - t0
+        if batch_idx not in done:
+            # keep a few batches per worker in flight, so that reading never runs far ahead
+            if len(pending) >= 2 * num_proc:
+                finish(pending.popleft())
+            pending.append(pool.apply_async(process, (batch_idx, docs)))
+        if time.time() - t_log > log_interval:
+            log()
+            t_log = time.time()
+        t0 = time.time()
+    while pending:
+        finish(pending.popleft())
+    pool.close()
+    pool.join()
+    journal.close()
+    log()
+
+    # every shard, as far as the journal has it, into the manifest. the documents end up
+    # ordered by worker, not as in the source, which sampling random windows doesn't mind
+    states = shard_states(records)
+    for split in splits:
+        shards = []
+        for w in sorted(states):
+            last, n_last = states[w][split]
+            for index in range(last + 1):
+                # the shards before the last one were complete when the worker moved on
+                path = os.path.join(out_dir, shard_name(split, w, index))
+                n = os.path.getsize(path) // np.dtype(dtype).itemsize if index < last else n_last
+                if n > 0:
+                    shards.append({'file': shard_name(split, w, index), 'num_tokens': n})
+        num_tokens = write_manifest(out_dir, split, shards, dtype, tiktoken.get_encoding("gpt2").n_vocab, shard_tokens)
+        print(f"{split} has {num_tokens:,} tokens in {len(shards)} shards")
+
     # train has ~9B tokens (9,035,582,198)
     # val has ~4M tokens (4,434,897)
 
-    # to read the bin files later, e.g. with numpy:
-    # m = np.memmap('train.bin', dtype=np.uint16, mode='r')
+    # to read the shards later, e.g. in train.py:
+    # from shards import open_split; train = open_split('data/openwebtext', 'train')
@@ -2,63 +2,51 @@
 Prepare the Shakespeare dataset for character-level language modeling.
 So instead of encoding with GPT-2 BPE tokens, we just map characters to ints.
 Will save train.bin, val.bin containing the ids, and meta.pkl containing the
-encoder and decoder and some other related info.
+encoder and decoder and some other related info, which charcodec.CharCodec.from_meta
+turns back into a codec. The ids are uint16, or uint32 for a vocabulary of more than
+2**16 characters, as recorded in meta.pkl's 'dtype'.
 """
 import os
+import sys
 import pickle
 import requests
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..')) # for charcodec.py
+from charcodec import scan_file
+
+chunk_chars = 2**24 # characters read, encoded and written at a time, so any size of corpus fits in memory
+
 # download the tiny shakespeare dataset
 input_file_path = os.path.join(os.path.dirname(__file__), 'input.txt')
 if not os.path.exists(input_file_path):
     data_url = 'https://raw.githubusercontent.com/karpathy/char-rnn/master/data/tinyshakespeare/input.txt'
-    with open(input_file_path, 'w') as f:
+    with open(input_file_path, 'w', encoding='utf-8') as f:
         f.write(requests.get(data_url).text)
 
-with open(input_file_path, 'r') as f:
-    data = f.read()
-print(f"length of dataset in characters: {len(data):,}")
-
-# get all the unique characters that occur in this text
-chars = sorted(list(set(data)))
-vocab_size = len(chars)
-print("all the unique characters:", ''.join(chars))
-print(f"vocab size: {vocab_size:,}")
-
-# create a mapping from characters to integers
-stoi = { ch:i for i,ch in enumerate(chars) }
-itos = { i:ch for i,ch in enumerate(chars) }
-def encode(s):
-    return [stoi[c] for c in s] # encoder: take a string, output a list of integers
-def decode(l):
-    return ''.join([itos[i] for i in l]) # decoder: take a list of integers, output a string
-
-# create the train and test splits
-n = len(data)
-train_data = data[:int(n*0.9)]
-val_data = data[int(n*0.9):]
-
-# encode both to integers
-train_ids = encode(train_data)
-val_ids = encode(val_data)
-print(f"train has {len(train_ids):,} tokens")
-print(f"val has {len(val_ids):,} tokens")
-
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
-train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
-val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
+# get all the unique characters that occur in this text, and its length, in one streaming pass
+codec, n = scan_file(input_file_path, chunk_chars)
+print(f"length of dataset in characters: {n:,}")
+print("all the unique characters:", ''.join(codec.chars))
+print(f"vocab size: {codec.vocab_size:,}, ids stored as {np.dtype(codec.dtype).name}")
+
+# encode the text chunk by chunk straight into the bin files: the first 90% of the
+# characters are the train split, the rest the val split
+n_train = int(n*0.9)
+written = 0
+with open(os.path.join(os.path.dirname(__file__), 'train.bin'), 'wb') as train_f, \
+     open(os.path.join(os.path.dirname(__file__), 'val.bin'), 'wb') as val_f:
+    for ids in codec.encode_file(input_file_path, chunk_chars):
+        k = min(max(n_train - written, 0), len(ids)) # how much of this chunk is still train
+        train_f.write(ids[:k].astype(codec.dtype).tobytes())
+        val_f.write(ids[k:].astype(codec.dtype).tobytes())
+        written += len(ids)
+print(f"train has {n_train:,} tokens")
+print(f"val has {n - n_train:,} tokens")
 
 # save the meta information as well, to help us encode/decode later
-meta = {
-    'vocab_size': vocab_size,
-    'itos': itos,
-    'stoi': stoi,
-}
 with open(os.path.join(os.path.dirname(__file__), 'meta.pkl'), 'wb') as f:
-    pickle.dump(meta, f)
+    pickle.dump(codec.meta(), f)
 
 # length of dataset in characters:  1115394
 # all the unique characters:
@@ -0,0 +1,165 @@
+"""
+Background-prefetching loader of (x, y) training batches from a tokenized split, a flat
+.bin file or any of the datasets of shards.py. A worker thread draws the batch_size
+window offsets, gathers all windows with one fancy-indexing op per file and writes them
+into one of a few reusable (pinned, when the batches go to cuda) host buffers, staying up
+to prefetch batches ahead of the training loop. The loop only pays for the host to device
+copy, and for whatever time it spends waiting on the worker, which the loader keeps
+count of.
+
+Windows are drawn at random offsets, or by an EpochSampler: without replacement, sharded
+across DDP ranks, and resumable from a checkpoint. Evaluation uses an EvalSet instead, a
+fixed set of windows held in memory.
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from shards import TokenFile
+
+
+class EpochSampler:
+    """
+    Offsets of non-overlapping block_size windows, without replacement: every epoch visits
+    each window of the split once, in a fresh random order. Rank r of num_replicas takes
+    every num_replicas-th batch of the epoch, so ranks never see the same window within
+    an epoch. The position is (epoch, step). Restoring it costs one permutation, not a replay.
+    """
+
+    def __init__(self, n_tokens, block_size, batch_size, rank=0, num_replicas=1, seed=1337):
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.seed = seed  # the same on every rank, they share the permutation
+        self.n_windows = (n_tokens - 1) // block_size  # y needs one token past every window
+        self.steps_per_epoch = self.n_windows // (batch_size * num_replicas)
+        assert self.steps_per_epoch > 0, "not enough tokens for one batch on every rank"
+        self.epoch, self.step = 0, 0
+        self.perm = None
+
+    def next(self):
+        if self.step == self.steps_per_epoch:
+            self.epoch, self.step, self.perm = self.epoch + 1, 0, None
+        if self.perm is None:
+            g = torch.Generator().manual_seed(self.seed + self.epoch)
+            self.perm = torch.randperm(self.n_windows, generator=g).numpy()
+        start = (self.step * self.num_replicas + self.rank) * self.batch_size
+        self.step += 1
+        return self.perm[start:start + self.batch_size] * self.block_size
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'step': self.step, 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        self.epoch, self.step, self.seed = state['epoch'], state['step'], state['seed']
+        self.perm = None
+
+
+class DataLoader:
+
+    def __init__(self, data, batch_size, block_size, device, prefetch=2, seed=1337, dtype=np.uint16, sampler=None):
+        self.data = TokenFile(data, dtype) if isinstance(data, str) else data  # a path or a shards.py dataset
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.device = device
+        self.cuda = 'cuda' in str(device)
+        self.generator = torch.Generator().manual_seed(seed)
+        self.sampler = sampler  # restore its state before handing it over, the worker starts drawing right away
+        # prefetch ready buffers, one the worker fills and one the training loop holds
+        n_slots = prefetch + 2
+        pin = self.cuda and torch.cuda.is_available()
+        self.x = [torch.empty((batch_size, block_size), dtype=torch.long, pin_memory=pin) for _ in range(n_slots)]
+        self.y = [torch.empty((batch_size, block_size), dtype=torch.long, pin_memory=pin) for _ in range(n_slots)]
+        self.copied = [None] * n_slots  # cuda event of the last copy out of each slot
+        self.states = [None] * n_slots  # sampler position before the batch in each slot
+        self.state = sampler.state_dict() if sampler is not None else None
+        self.free = queue.Queue()
+        for i in range(n_slots):
+            self.free.put(i)
+        self.ready = queue.Queue(maxsize=prefetch)
+        self.wait_time = 0.0  # seconds the training loop spent waiting for batches, see pop_wait_time
+        self.error = None
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def offsets(self):
+        # the first token of every window in the batch
+        if self.sampler is not None:
+            return self.sampler.next()
+        return self.data.random_starts(self.batch_size, self.block_size + 1, self.generator)
+
+    def _worker(self):
+        try:
+            while True:
+                i = self.free.get()
+                if self.copied[i] is not None:
+                    self.copied[i].synchronize()  # the last batch in this slot is on the device already
+                self.states[i] = self.sampler.state_dict() if self.sampler is not None else None
+                batch = self.data.gather(self.offsets(), self.block_size + 1)  # (batch_size, block_size + 1)
+                self.x[i].numpy()[...] = batch[:, :-1]
+                self.y[i].numpy()[...] = batch[:, 1:]
+                self.ready.put(i)
+        except Exception as e:
+            self.error = e
+            self.ready.put(None)
+
+    def next(self):
+        t0 = time.time()
+        i = self.ready.get()
+        self.wait_time += time.time() - t0
+        if i is None:
+            raise RuntimeError("the data loader failed") from self.error
+        self.state = self.states[i]
+        if self.cuda:
+            # pinned arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
+            x = self.x[i].to(self.device, non_blocking=True)
+            y = self.y[i].to(self.device, non_blocking=True)
+            self.copied[i] = torch.cuda.Event()
+            self.copied[i].record()
+        else:
+            # the caller may hold on to the batch (e.g. for the backward pass) after the slot is refilled
+            x, y = self.x[i].to(self.device, copy=True), self.y[i].to(self.device, copy=True)
+        self.free.put(i)
+        return x, y
+
+    def state_dict(self):
+        # the sampler position before the batch handed out last: the batch a training loop
+        # holds but hasn't trained on yet when it saves a checkpoint, so a resumed run starts
+        # with it again. the batches prefetched beyond it are simply drawn again
+        return self.state
+
+    def pop_wait_time(self):
+        # seconds spent waiting on the worker since the last call
+        t, self.wait_time = self.wait_time, 0.0
+        return t
+
+
+class EvalSet:
+    """
+    A fixed set of n random windows of a split, drawn once (the same on every rank, for the
+    same seed) and held in memory, so that every evaluation scores exactly the same tokens
+    and evaluations are comparable with each other.
+    """
+
+    def __init__(self, data, n, block_size, seed=1337, dtype=np.uint16):
+        data = TokenFile(data, dtype) if isinstance(data, str) else data
+        generator = torch.Generator().manual_seed(seed)
+        windows = data.gather(data.random_starts(n, block_size + 1, generator), block_size + 1)
+        self.windows = torch.from_numpy(windows.astype(np.int32))  # (n, block_size + 1), half the memory of int64
+
+    def __len__(self):
+        return len(self.windows)
+
+    def batches(self, batch_size, device, rank=0, world_size=1):
+        # (x, y) batches on device of this rank's share of the windows: every world_size-th one
+        windows = self.windows[rank::world_size]
+        for i in range(0, len(windows), batch_size):
+            w = windows[i:i + batch_size]
+            if 'cuda' in str(device) and torch.cuda.is_available():
+                w = w.pin_memory().to(device, non_blocking=True)
+            w = w.to(device).long()
+            yield w[:, :-1].contiguous(), w[:, 1:].contiguous()
@@ -0,0 +1,72 @@
+"""
+Load generator for serve.py: fire num_requests generation requests, concurrency at a time,
+and report latency percentiles, time to first token and aggregate tokens/sec.
+
+$ python serve.py --out_dir=out-shakespeare-char --device=cpu &
+$ python loadgen.py --concurrency=16 --num_requests=128
+"""
+import json
+import time
+import threading
+import http.client
+
+# -----------------------------------------------------------------------------
+host = '127.0.0.1'
+port = 8000
+prompt = "\n"
+num_requests = 64 # total number of requests to send
+concurrency = 8 # number of requests in flight at any time
+max_new_tokens = 100
+temperature = 0.8
+top_k = 200
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+def one_request():
+    # returns (latency, time to first token, number of tokens received)
+    t0 = time.time()
+    conn = http.client.HTTPConnection(host, port)
+    body = json.dumps(dict(prompt=prompt, max_new_tokens=max_new_tokens, temperature=temperature, top_k=top_k))
+    conn.request('POST', '/generate', body=body, headers={'Content-Type': 'application/json'})
+    resp = conn.getresponse()
+    assert resp.status == 200, f"server returned {resp.status} {resp.reason}"
+    ttft, n_tokens = None, 0
+    for line in resp: # http.client undoes the chunked encoding for us
+        msg = json.loads(line)
+        if 'token' in msg:
+            n_tokens += 1
+            ttft = ttft if ttft is not None else time.time() - t0
+    conn.close()
+    return time.time() - t0, ttft, n_tokens
+
+results = []
+lock = threading.Lock()
+todo = iter(range(num_requests))
+def worker():
+    while True:
+        with lock:
+            if next(todo, None) is None:
+                return
+        r = one_request()
+        with lock:
+            results.append(r)
+
+t0 = time.time()
+threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+dt = time.time() - t0
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+latencies = [r[0] for r in results]
+ttfts = [r[1] for r in results if r[1] is not None]
+n_tokens = sum(r[2] for r in results)
+print(f"{len(results)} requests, concurrency {concurrency}, {dt:.2f}s wall clock")
+print(f"latency: p50 {percentile(latencies, 50)*1000:.0f}ms, p99 {percentile(latencies, 99)*1000:.0f}ms")
+print(f"time to first token: p50 {percentile(ttfts, 50)*1000:.0f}ms, p99 {percentile(ttfts, 99)*1000:.0f}ms")
+print(f"throughput: {n_tokens / dt:.2f} tokens/sec, {len(results) / dt:.2f} requests/sec")
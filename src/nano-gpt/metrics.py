@@ -0,0 +1,98 @@
+"""
+Training metrics that never make the host wait for the device. Values such as the loss
+and the gradient norm are added up as device tensors, step after step. At log time
+flush() copies all of them to pinned host memory in one non-blocking copy and returns
+right away. ready() hands out the flushed values once the device has caught up with
+the copy, which at the next log is long done. So logging every iteration costs about
+as much as logging every 100 iterations: nothing calls .item() on a value the device
+may still be computing. Counts the host knows anyway, such as the tokens of every batch,
+are kept on the host and reported as totals and rates over the log interval.
+"""
+
+import time
+from collections import deque
+
+import torch
+
+
+class Metrics:
+
+    def __init__(self, device):
+        self.device = device
+        self.cuda = 'cuda' in str(device) and torch.cuda.is_available()
+        self.sums = {}  # name -> 0-dim float32 device tensor
+        self.maxes = {}
+        self.counts = {}  # name -> python number, known on the host
+        self.iters = 0  # step() calls since the last flush, known on the host
+        self.t_flush = time.time()
+        self.pending = deque()  # flushed and not yet handed out by ready()
+
+    def add(self, name, value):
+        # add value (a 0-dim tensor on the device) to the running sum of name. flush
+        # reports the sum divided by the number of iterations it was collected over
+        value = value.detach().float()
+        if name in self.sums:
+            self.sums[name].add_(value)
+        else:
+            self.sums[name] = value.clone()
+
+    def maximum(self, name, value):
+        # keep the largest value of name since the last flush, reported as name + '_max'
+        value = value.detach().float()
+        if name in self.maxes:
+            torch.maximum(self.maxes[name], value, out=self.maxes[name])
+        else:
+            self.maxes[name] = value.clone()
+
+    def count(self, name, n):
+        # add n (e.g. the tokens of a batch) to the counter of name. flush reports the total
+        # since the last flush as name, and the rate over that wall time as name + '/sec'
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def step(self):
+        # one training iteration is done
+        self.iters += 1
+
+    def flush(self, iter_num, **host):
+        """
+        Start copying the metrics collected since the last flush to the host, and reset
+        them. host: values known on the host already (e.g. timings), reported alongside.
+        """
+        t = time.time()
+        elapsed, self.t_flush = t - self.t_flush, t
+        host = {**host, **self.counts, **{name + '/sec': n / elapsed for name, n in self.counts.items()}}
+        names = list(self.sums) + [name + '_max' for name in self.maxes]
+        values = list(self.sums.values()) + list(self.maxes.values())
+        event = None
+        if values:
+            values = torch.stack(values)
+            if self.cuda:
+                buf = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+                buf.copy_(values, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                values = buf
+            else:
+                values = values.cpu()
+        self.pending.append((iter_num, names, len(self.sums), max(self.iters, 1), values, event, host))
+        self.sums, self.maxes, self.counts, self.iters = {}, {}, {}, 0
+
+    def ready(self, wait=False):
+        """
+        [(iter_num, metrics dict)] of every flush whose copy has landed, in order. Sums are
+        averaged over the iterations they were collected over. wait=True waits for all of them.
+        """
+        out = []
+        while self.pending:
+            iter_num, names, n_sums, iters, values, event, host = self.pending[0]
+            if event is not None:
+                if wait:
+                    event.synchronize()
+                elif not event.query():
+                    break
+            self.pending.popleft()
+            values = values.tolist() if len(names) else []
+            metrics = {name: v / iters if i < n_sums else v for i, (name, v) in enumerate(zip(names, values))}
+            metrics.update(host)
+            out.append((iter_num, metrics))
+        return out
@@ -9,12 +9,18 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import math
 import inspect
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import functional as F
 
+from sampling import sample, distribution, real_vocab_size
+from weights import gpt2_state_dict
+from throughput import flops_per_token
+
 
 class LayerNorm(nn.Module):
     """LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False"""
@@ -28,13 +34,428 @@ class LayerNorm(nn.Module):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
 
+class KVCache:
+    """
+    Key/value cache for incremental decoding: one (B, nh, max_len, hs) buffer pair per layer.
+    Buffers are allocated lazily on first use so they pick up the batch size and the dtype
+    that autocast produces. They start zeroed: padding slots are masked out of attention,
+    but must not hold NaNs that would leak through the zero attention weights.
+    GPT.forward appends the new positions to every layer, then advances pos, the number of
+    positions held (the same for all layers). For left-padded batches, mask records which
+    of those positions hold real tokens.
+    """
+
+    def __init__(self, config, max_len=None):
+        self.max_len = max_len or config.block_size
+        self.k = [None] * config.n_layer
+        self.v = [None] * config.n_layer
+        self.mask = None  # (B, max_len) bool, only allocated once padding shows up
+        self.pos = 0
+
+    def begin(self, idx, pad_mask=None):
+        # called by GPT.forward before the layers. records the pad_mask (B, T) of the new
+        # positions and returns the mask of all keys (B, pos + T), or None if nothing is padded
+        if pad_mask is None and self.mask is None:
+            return None
+        B, T = idx.size()
+        if pad_mask is None:
+            pad_mask = torch.ones(B, T, dtype=torch.bool, device=idx.device)
+        if self.mask is None:
+            self.mask = torch.ones(B, self.max_len, dtype=torch.bool, device=pad_mask.device)
+        self.mask[:, self.pos:self.pos + T] = pad_mask
+        return self.mask[:, :self.pos + T]
+
+    def update(self, layer_idx, k, v):
+        # write the new keys/values (B, nh, T, hs) at pos and return everything cached so far
+        B, nh, T, hs = k.size()
+        assert self.pos + T <= self.max_len, f"KV cache overflow: {self.pos + T} > {self.max_len}"
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_zeros(B, nh, self.max_len, hs)
+            self.v[layer_idx] = v.new_zeros(B, nh, self.max_len, hs)
+        self.k[layer_idx][:, :, self.pos:self.pos + T] = k
+        self.v[layer_idx][:, :, self.pos:self.pos + T] = v
+        return self.k[layer_idx][:, :, :self.pos + T], self.v[layer_idx][:, :, :self.pos + T]
+
+    def advance(self, t):
+        self.pos += t
+
+    def reset(self):
+        # keep the buffers around, just forget what is in them
+        self.pos = 0
+
+    def truncate(self, n):
+        # forget everything past the first n positions, e.g. rejected speculative tokens
+        self.pos = min(self.pos, n)
+
+    def read(self, layer_idx, row, start, end):
+        # keys/values (nh, end - start, hs) of the real tokens start..end-1 of one row
+        offset = self.pos - int(self.lengths()[row])  # left padding of that row
+        return (self.k[layer_idx][row, :, offset + start:offset + end],
+                self.v[layer_idx][row, :, offset + start:offset + end])
+
+    # the methods below let a serving loop treat the batch dim as a set of independent
+    # sequences, each right-aligned at pos and marked in mask (left padding)
+
+    def _ensure_mask(self):
+        if self.mask is None:
+            self.mask = torch.ones(self.k[0].size(0), self.max_len, dtype=torch.bool, device=self.k[0].device)
+
+    def lengths(self):
+        # number of real tokens cached per row, (B,)
+        if self.mask is None:
+            return torch.full((self.k[0].size(0),), self.pos, dtype=torch.long, device=self.k[0].device)
+        return self.mask[:, :self.pos].sum(dim=1)
+
+    def shift(self, d):
+        # move the cached positions d slots to the left, dropping the oldest d (they must be
+        # padding in every row), or -d slots to the right, padding every row on the left
+        if d == 0:
+            return
+        n = self.pos - max(d, 0)  # number of slots that survive
+        src, dst = (d, 0) if d > 0 else (0, -d)
+        assert dst + n <= self.max_len, f"KV cache overflow: {dst + n} > {self.max_len}"
+        self._ensure_mask()
+        for buf in self.k + self.v:
+            buf[:, :, dst:dst + n] = buf[:, :, src:src + n].clone()
+        self.mask[:, dst:dst + n] = self.mask[:, src:src + n].clone()
+        self.mask[:, :dst] = False
+        self.pos = dst + n
+
+    def compact(self):
+        # drop the leading slots that are padding in every row, returns how many were freed
+        d = self.pos - int(self.lengths().max())
+        self.shift(d)
+        return d
+
+    def keep_rows(self, rows):
+        # keep only the given batch rows (LongTensor of row indices), e.g. to evict finished sequences
+        self.k = [buf[rows] for buf in self.k]
+        self.v = [buf[rows] for buf in self.v]
+        if self.mask is not None:
+            self.mask = self.mask[rows]
+
+    def extend(self, other):
+        # append the rows of another cache (e.g. freshly prefilled prompts) to this batch.
+        # both get right-aligned at the larger of the two positions first
+        self._ensure_mask()
+        other._ensure_mask()
+        pos = max(self.pos, other.pos)
+        self.shift(self.pos - pos)
+        other.shift(other.pos - pos)
+        self.k = [torch.cat((a, b)) for a, b in zip(self.k, other.k)]
+        self.v = [torch.cat((a, b)) for a, b in zip(self.v, other.v)]
+        self.mask = torch.cat((self.mask, other.mask))
+
+
+class KVPool:
+    """
+    Block storage shared by PagedKVCache: every layer keeps its keys/values in blocks of
+    block_len positions, (num_blocks, nh, block_len, hs), handed out through a free list.
+    Storage starts at init_blocks and doubles whenever the free list runs dry (up to
+    max_blocks), so memory follows the number of tokens actually cached.
+    """
+
+    def __init__(self, config, block_len=16, init_blocks=64, max_blocks=None):
+        self.block_len = block_len
+        self.max_blocks = max_blocks
+        self.k = [None] * config.n_layer
+        self.v = [None] * config.n_layer
+        self.capacity = init_blocks if max_blocks is None else min(init_blocks, max_blocks)
+        self.free = list(range(self.capacity - 1, -1, -1))  # pop() hands out low block ids first
+        self.n_tokens = 0  # positions held, summed over all sequences
+        self.peak_blocks = 0
+
+    def alloc(self):
+        if not self.free:
+            grow = self.capacity if self.max_blocks is None else min(self.capacity, self.max_blocks - self.capacity)
+            if grow <= 0:
+                raise RuntimeError(f"KV pool exhausted, all {self.capacity} blocks are in use")
+            self.free = list(range(self.capacity + grow - 1, self.capacity - 1, -1))
+            self.capacity += grow
+        block = self.free.pop()
+        self.peak_blocks = max(self.peak_blocks, self.capacity - len(self.free))
+        return block
+
+    def release(self, blocks):
+        self.free.extend(reversed(blocks))
+
+    def available(self):
+        # blocks alloc() can still hand out, including the growth max_blocks allows
+        if self.max_blocks is None:
+            return float('inf')
+        return len(self.free) + self.max_blocks - self.capacity
+
+    def storage(self, layer_idx, k):
+        # key/value storage of one layer, shaped after k (B, nh, T, hs) and grown to capacity
+        old_k, old_v = self.k[layer_idx], self.v[layer_idx]
+        if old_k is None or old_k.size(0) < self.capacity:
+            _, nh, _, hs = k.size()
+            self.k[layer_idx] = k.new_zeros(self.capacity, nh, self.block_len, hs)
+            self.v[layer_idx] = k.new_zeros(self.capacity, nh, self.block_len, hs)
+            if old_k is not None:
+                self.k[layer_idx][:old_k.size(0)] = old_k
+                self.v[layer_idx][:old_v.size(0)] = old_v
+        return self.k[layer_idx], self.v[layer_idx]
+
+    def stats(self):
+        """
+        Occupancy is the fraction of allocated blocks handed out to sequences. Fragmentation
+        is the fraction of slots in handed-out blocks that hold no token, i.e. the unfilled
+        tails of the last block of every sequence (paging has no external fragmentation).
+        """
+        used = self.capacity - len(self.free)
+        block_bytes = sum(2 * k[0].numel() * k.element_size() for k in self.k if k is not None)
+        return {
+            'block_len': self.block_len,
+            'blocks_allocated': self.capacity,
+            'blocks_used': used,
+            'blocks_peak': self.peak_blocks,
+            'tokens': self.n_tokens,
+            'occupancy': used / self.capacity,
+            'fragmentation': 1.0 - self.n_tokens / (used * self.block_len) if used else 0.0,
+            'bytes_allocated': self.capacity * block_bytes,
+            'bytes_used': used * block_bytes,
+        }
+
+
+class PagedKVCache:
+    """
+    Drop-in replacement for KVCache that keeps every sequence (batch row) in fixed-size
+    blocks of a KVPool, listed in a per-row block table. A row only holds blocks for the
+    tokens it has, not for block_size positions, and finished rows hand their blocks back.
+    Attention still sees dense (B, nh, S, hs) keys/values: update() gathers all rows
+    right-aligned at S = pos + T, the same left-padded layout KVCache uses. pos is the
+    length of the longest row.
+    """
+
+    def __init__(self, pool, config):
+        self.pool = pool
+        self.max_len = config.block_size
+        self.tables = []  # per row, the ids of the blocks holding its positions in order
+        self.lens = []  # per row, the number of positions held
+        self.n_new = None  # per row, real tokens in the forward in flight
+        self.scatter = None  # where update() writes the new tokens, see begin()
+        self.gather = None  # (block, offset) to read for every (row, slot) of the dense view
+
+    @property
+    def pos(self):
+        return max(self.lens, default=0)
+
+    def begin(self, idx, pad_mask=None):
+        # called by GPT.forward before the layers: reserve blocks for the real new tokens and
+        # precompute the scatter/gather indices all layers share. returns the key mask (B, S)
+        B, T = idx.size()
+        device = idx.device
+        if not self.lens:
+            self.tables, self.lens = [[] for _ in range(B)], [0] * B
+        assert len(self.lens) == B, f"batch of {B} rows for a cache of {len(self.lens)}"
+        self.n_new = pad_mask.sum(dim=1).tolist() if pad_mask is not None else [T] * B
+        bl = self.pool.block_len
+        rows, ts, blocks, offsets = [], [], [], []
+        for b, (table, L, n) in enumerate(zip(self.tables, self.lens, self.n_new)):
+            while len(table) * bl < L + n:
+                table.append(self.pool.alloc())
+            for j in range(n):
+                rows.append(b)
+                ts.append(T - n + j)  # the real tokens sit at the right of idx
+                blocks.append(table[(L + j) // bl])
+                offsets.append((L + j) % bl)
+        self.scatter = [torch.tensor(a, dtype=torch.long, device=device) for a in (rows, ts, blocks, offsets)]
+        # dense view: slot s of row b holds token s - (S - len_b) of that row, if that is >= 0
+        S = self.pos + T
+        lens = torch.tensor([L + n for L, n in zip(self.lens, self.n_new)], device=device)
+        tok = torch.arange(S, device=device)[None, :] - (S - lens)[:, None]  # (B, S)
+        key_mask = tok >= 0
+        tok = tok.clamp(min=0)
+        n_blocks = max(1, max(len(table) for table in self.tables))
+        table = torch.tensor([table + [0] * (n_blocks - len(table)) for table in self.tables], dtype=torch.long, device=device)
+        self.gather = (table.gather(1, tok // bl), tok % bl)
+        return key_mask
+
+    def update(self, layer_idx, k, v):
+        # scatter the real new keys/values into the pool, then gather the dense (B, nh, S, hs) view
+        pool_k, pool_v = self.pool.storage(layer_idx, k)
+        rows, ts, blocks, offsets = self.scatter
+        pool_k[blocks, :, offsets] = k[rows, :, ts]
+        pool_v[blocks, :, offsets] = v[rows, :, ts]
+        gb, go = self.gather
+        return pool_k[gb, :, go].transpose(1, 2), pool_v[gb, :, go].transpose(1, 2)
+
+    def read(self, layer_idx, row, start, end):
+        # keys/values (nh, end - start, hs) of the tokens start..end-1 of one row
+        pool_k, pool_v = self.pool.k[layer_idx], self.pool.v[layer_idx]
+        t = torch.arange(start, end, device=pool_k.device)
+        blocks = torch.tensor(self.tables[row], dtype=torch.long, device=pool_k.device)[t // self.pool.block_len]
+        offsets = t % self.pool.block_len
+        return pool_k[blocks, :, offsets].transpose(0, 1), pool_v[blocks, :, offsets].transpose(0, 1)
+
+    def advance(self, t):
+        self.lens = [L + n for L, n in zip(self.lens, self.n_new)]
+        self.pool.n_tokens += sum(self.n_new)
+
+    def reset(self):
+        # give all blocks back but keep the rows
+        for table in self.tables:
+            self.pool.release(table)
+        self.pool.n_tokens -= sum(self.lens)
+        self.tables = [[] for _ in self.tables]
+        self.lens = [0] * len(self.lens)
+
+    def free(self):
+        # give all blocks back and drop all rows
+        self.reset()
+        self.tables, self.lens = [], []
+
+    # same serving interface as KVCache
+
+    def lengths(self):
+        return torch.tensor(self.lens, dtype=torch.long)
+
+    def compact(self):
+        return 0  # rows never hold padding, so there is nothing to compact
+
+    def keep_rows(self, rows):
+        rows = rows.tolist() if torch.is_tensor(rows) else list(rows)
+        for b in set(range(len(self.lens))) - set(rows):
+            self.pool.release(self.tables[b])
+            self.pool.n_tokens -= self.lens[b]
+        self.tables = [self.tables[b] for b in rows]
+        self.lens = [self.lens[b] for b in rows]
+
+    def extend(self, other):
+        # take over the rows of another cache on the same pool (e.g. freshly prefilled prompts)
+        assert other.pool is self.pool, "can only merge paged caches that share a KVPool"
+        self.tables += other.tables
+        self.lens += other.lens
+        other.tables, other.lens = [], []
+
+
+class PrefixCache:
+    """
+    Keys/values of prompt prefixes, computed once and shared by every sample and request that
+    starts with the same tokens. Prompts are cut into aligned chunks of chunk_len tokens and
+    chunk i is keyed on a hash chained over chunks 0..i, so a lookup walks the chunks of a
+    prompt until the first miss. Entries hold (nh, chunk_len, hs) keys/values per layer, for
+    any batch size, and the least recently used ones go once max_bytes is exceeded. The
+    entries are only valid for the model (and autocast dtype) that computed them.
+    """
+
+    def __init__(self, config, chunk_len=64, max_bytes=256 * 2**20):
+        self.config = config
+        self.chunk_len = chunk_len
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (parent key, chunk tokens, [(k, v) per layer], nbytes)
+        self.bytes = 0
+        # counters
+        self.lookups = 0
+        self.hits = 0  # lookups that found at least one chunk
+        self.tokens_queried = 0
+        self.tokens_hit = 0
+        self.evictions = 0
+
+    def _keys(self, ids):
+        # (key, parent key, chunk) for the full chunks of ids, always leaving out the last
+        # token: the forward over it gives the logits to sample from
+        keys, parent = [], None
+        C = self.chunk_len
+        for i in range((len(ids) - 1) // C):
+            chunk = tuple(ids[i * C:(i + 1) * C])
+            key = hash((parent, chunk))
+            keys.append((key, parent, chunk))
+            parent = key
+        return keys
+
+    def _match(self, keys):
+        # keys of the longest cached prefix. parent and tokens are checked, so a hash collision is just a miss
+        matched = []
+        for key, parent, chunk in keys:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != parent or entry[1] != chunk:
+                break
+            matched.append(key)
+        return matched
+
+    def _touch(self, keys):
+        # mark as most recently used. the shortest prefix goes last, so that it outlives
+        # the longer prefixes that can't be reached without it
+        for key in reversed(keys):
+            self.entries.move_to_end(key)
+
+    def _load(self, matched, kv_cache, batch_size):
+        if not matched:
+            return 0
+        chunks = [self.entries[key][2] for key in matched]
+        m = len(matched) * self.chunk_len
+        dummy = torch.zeros(batch_size, m, dtype=torch.long, device=chunks[0][0][0].device)
+        kv_cache.begin(dummy)
+        for i in range(self.config.n_layer):
+            k = torch.cat([layers[i][0] for layers in chunks], dim=1)[None].expand(batch_size, -1, -1, -1)
+            v = torch.cat([layers[i][1] for layers in chunks], dim=1)[None].expand(batch_size, -1, -1, -1)
+            kv_cache.update(i, k, v)
+        kv_cache.advance(m)
+        return m
+
+    def load(self, ids, kv_cache, batch_size=1):
+        """
+        Write the longest cached prefix of the token ids into every row of the empty kv_cache
+        (KVCache or PagedKVCache) and return its length. Forward the rest, ids[length:], next.
+        """
+        matched = self._match(self._keys(ids))
+        self._touch(matched)
+        m = self._load(matched, kv_cache, batch_size)
+        self.lookups += 1
+        self.hits += m > 0
+        self.tokens_queried += len(ids)
+        self.tokens_hit += m
+        return m
+
+    @torch.no_grad()
+    def fill(self, model, ids):
+        # compute and store the full chunks of ids that are not cached yet, with a batch-1 forward
+        keys = self._keys(ids)
+        matched = self._match(keys)
+        if len(matched) < len(keys):
+            C = self.chunk_len
+            kv_cache = KVCache(self.config)
+            m = self._load(matched, kv_cache, 1)
+            idx = torch.tensor(ids[m:len(keys) * C], dtype=torch.long, device=model.lm_head.weight.device)[None, ...]
+            model(idx, kv_cache=kv_cache)
+            for i in range(len(matched), len(keys)):
+                key, parent, chunk = keys[i]
+                layers = [tuple(t.clone() for t in kv_cache.read(j, 0, i * C, (i + 1) * C)) for j in range(self.config.n_layer)]
+                nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+                self.entries[key] = (parent, chunk, layers, nbytes)
+                self.bytes += nbytes
+        self._touch([key for key, _, _ in keys])
+        while self.bytes > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry[3]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'lookups': self.lookups,
+            'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+            'token_hit_rate': self.tokens_hit / self.tokens_queried if self.tokens_queried else 0.0,
+            'evictions': self.evictions,
+        }
+
+
 class CausalSelfAttention(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_head == 0
+        # grouped-query attention: every n_head // n_kv_head query heads share one key/value head
+        n_kv_head = config.n_kv_head or config.n_head
+        assert config.n_head % n_kv_head == 0
+        self.n_kv_head = n_kv_head
+        self.kv_dim = n_kv_head * (config.n_embd // config.n_head)
         # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=config.bias)
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_dim, bias=config.bias)
         # output projection
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=config.bias)
         # regularization
@@ -43,6 +464,7 @@ class CausalSelfAttention(nn.Module):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         self.dropout = config.dropout
+        self.layer_idx = layer_idx  # which slot of a KVCache this layer reads and writes
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
         if not self.flash:
@@ -51,26 +473,44 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+        q, k, v = self.c_attn(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)  # (B, nkv, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+        v = v.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)  # (B, nkv, T, hs)
+        if kv_cache is not None:
+            # prepend the keys/values of all previous positions, k and v become (B, nkv, S, hs)
+            # the cache only ever holds the n_kv_head heads, that is where GQA saves memory
+            k, v = kv_cache.update(self.layer_idx, k, v)
+        if self.n_kv_head != self.n_head:
+            # query head h reads key/value head h // (nh // nkv)
+            k = k.repeat_interleave(self.n_head // self.n_kv_head, dim=1)  # (B, nh, S, hs)
+            v = v.repeat_interleave(self.n_head // self.n_kv_head, dim=1)  # (B, nh, S, hs)
+        S = k.size(2)  # S == T unless we are decoding on top of a cache
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, S) -> (B, nh, T, S)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            # is_causal aligns the mask to the top-left, which is only right when T == S. A single
+            # new token may attend to everything, otherwise the queries sit at the last T positions
+            # an explicit attn_mask (B, 1, T, S) from GPT.forward already includes the causal part
+            is_causal = attn_mask is None and T == S
+            if attn_mask is None and T != S and T > 1:
+                attn_mask = torch.ones(T, S, dtype=torch.bool, device=x.device).tril(diagonal=S - T)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=is_causal)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:, :, :T, :T] == 0, float('-inf'))
+            if attn_mask is not None:
+                att = att.masked_fill(~attn_mask, float('-inf'))
+            else:
+                att = att.masked_fill(self.bias[:, :, S - T:S, :S] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
-            y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+            y = att @ v  # (B, nh, T, S) x (B, nh, S, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C)  # re-assemble all head outputs side by side
 
         # output projection
@@ -97,28 +537,89 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln_1 = LayerNorm(config.n_embd, bias=config.bias)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
-        x = x + self.mlp(self.ln_2(x))
+    def forward(self, x, kv_cache=None, attn_mask=None, recompute=''):
+        # recompute: activations of the whole 'block', or of just its 'attn' or 'mlp' half, are
+        # dropped after the forward pass and recomputed in the backward pass
+        if recompute == 'block':
+            return torch.utils.checkpoint.checkpoint(self._forward, x, kv_cache, attn_mask, use_reentrant=False)
+        return self._forward(x, kv_cache, attn_mask, recompute)
+
+    def _forward(self, x, kv_cache=None, attn_mask=None, recompute=''):
+        attn = lambda h: self.attn(self.ln_1(h), kv_cache, attn_mask)
+        mlp = lambda h: self.mlp(self.ln_2(h))
+        x = x + (torch.utils.checkpoint.checkpoint(attn, x, use_reentrant=False) if recompute == 'attn' else attn(x))
+        x = x + (torch.utils.checkpoint.checkpoint(mlp, x, use_reentrant=False) if recompute == 'mlp' else mlp(x))
         return x
 
 
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Fused lm_head projection + cross-entropy that never holds more than (chunk_size, vocab_size)
+    logits. The forward keeps only the logsumexp of every row, the backward recomputes the
+    logits of one chunk at a time and turns them into softmax - onehot gradients. Matmuls
+    run in whatever dtype autocast gave the forward projection, the softmax in float32.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size):
+        # x (N, C), weight (V, C), targets (N,) with -1 for positions to ignore
+        valid = targets != -1
+        lse = torch.empty(x.size(0), dtype=torch.float32, device=x.device)
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        for i in range(0, x.size(0), chunk_size):
+            logits = F.linear(x[i:i + chunk_size], weight)
+            ctx.dtype = logits.dtype
+            logits = logits.float()
+            lse[i:i + chunk_size] = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(1, targets[i:i + chunk_size].clamp(min=0)[:, None])[:, 0]
+            loss += ((lse[i:i + chunk_size] - target_logits) * valid[i:i + chunk_size]).sum()
+        n_valid = valid.sum().clamp(min=1)
+        ctx.save_for_backward(x, weight, targets, lse, n_valid)
+        ctx.chunk_size = chunk_size
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        x, weight, targets, lse, n_valid = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        w = weight.to(ctx.dtype)
+        grad_x = torch.empty_like(x) if ctx.needs_input_grad[0] else None
+        grad_w = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if ctx.needs_input_grad[1] else None
+        scale = grad_loss / n_valid
+        for i in range(0, x.size(0), chunk_size):
+            xc = x[i:i + chunk_size].to(ctx.dtype)
+            t = targets[i:i + chunk_size]
+            # d loss / d logits = (softmax - onehot(target)) / n_valid, zero on ignored rows
+            g = torch.exp(F.linear(xc, w).float() - lse[i:i + chunk_size, None])
+            g[torch.arange(g.size(0), device=g.device), t.clamp(min=0)] -= 1
+            g = (g * (scale * (t != -1))[:, None]).to(ctx.dtype)
+            if grad_x is not None:
+                grad_x[i:i + chunk_size] = g @ w
+            if grad_w is not None:
+                grad_w += (g.t() @ xc).float()
+        return grad_x, grad_w.to(weight.dtype) if grad_w is not None else None, None, None
+
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024
     vocab_size: int = 50304  # GPT-2 vocab_size of 50257, padded up to nearest multiple of 64 for efficiency
     n_layer: int = 12
     n_head: int = 12
+    n_kv_head: int = 0  # key/value heads, from 1 (multi-query) to n_head (grouped-query in between); 0 means n_head
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = True  # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
+    loss_chunk_size: int = 0  # > 0: fuse lm_head and the loss over chunks of this many positions, see ChunkedCrossEntropy
+    recompute: str = ''  # activation checkpointing in training: '' (off), 'block', 'attn' or 'mlp', see Block.forward
+    recompute_every: int = 1  # recompute only in every Nth block, starting with the first
 
 
 class GPT(nn.Module):
@@ -127,13 +628,15 @@ class GPT(nn.Module):
         super().__init__()
         assert config.vocab_size is not None
         assert config.block_size is not None
+        assert config.recompute in {'', 'block', 'attn', 'mlp'}
+        assert config.recompute_every >= 1, "recompute_every must be at least 1"
         self.config = config
 
         self.transformer = nn.ModuleDict(dict(
             wte=nn.Embedding(config.vocab_size, config.n_embd),
             wpe=nn.Embedding(config.block_size, config.n_embd),
             drop=nn.Dropout(config.dropout),
-            h=nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h=nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f=LayerNorm(config.n_embd, bias=config.bias),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
@@ -143,12 +646,13 @@ class GPT(nn.Module):
         # not 100% sure what this is, so far seems to be harmless. TODO investigate
         self.transformer.wte.weight = self.lm_head.weight  # https://paperswithcode.com/method/weight-tying
 
-        # init all weights
-        self.apply(self._init_weights)
-        # apply special scaled init to the residual projections, per GPT-2 paper
-        for pn, p in self.named_parameters():
-            if pn.endswith('c_proj.weight'):
-                torch.nn.init.normal_(p, mean=0.0, std=0.02/math.sqrt(2 * config.n_layer))
+        # init all weights, unless the model is built on the meta device to load weights into
+        if not self.lm_head.weight.is_meta:
+            self.apply(self._init_weights)
+            # apply special scaled init to the residual projections, per GPT-2 paper
+            for pn, p in self.named_parameters():
+                if pn.endswith('c_proj.weight'):
+                    torch.nn.init.normal_(p, mean=0.0, std=0.02/math.sqrt(2 * config.n_layer))
 
         # report number of parameters
         print("number of parameters: %.2fM" % (self.get_num_params()/1e6,))
@@ -173,24 +677,50 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, pad_mask=None, all_logits=False):
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device)  # shape (t)
+        # with a kv_cache, idx holds only the new tokens and they continue after the cached ones
+        start = kv_cache.pos if kv_cache is not None else 0
+        assert start + t <= self.config.block_size, f"Cannot forward sequence of length {start + t}, block size is only {self.config.block_size}"
+        attn_mask = None
+        key_mask = kv_cache.begin(idx, pad_mask) if kv_cache is not None else pad_mask  # (b, s) or None
+        if key_mask is None:
+            pos = torch.arange(start, start + t, dtype=torch.long, device=device)  # shape (t)
+        else:
+            # left-padded batch: pad_mask (b, t) is True for real tokens. every row numbers its
+            # own real tokens from 0, and nobody attends to the padding
+            if pad_mask is None:
+                pad_mask = torch.ones(b, t, dtype=torch.bool, device=device)
+            past = key_mask.sum(dim=1, keepdim=True) - pad_mask.sum(dim=1, keepdim=True)
+            pos = (past + pad_mask.cumsum(dim=1) - 1).clamp(min=0)  # shape (b, t)
+            attn_mask = self._attn_mask(key_mask, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (t, n_embd)
+        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (t, n_embd) or (b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        # trade compute for memory by recomputing activations in the backward pass, training only
+        recompute = self.config.recompute if self.training and torch.is_grad_enabled() and kv_cache is None else ''
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache, attn_mask, recompute if i % self.config.recompute_every == 0 else '')
+        if kv_cache is not None:
+            kv_cache.advance(t)
         x = self.transformer.ln_f(x)
 
-        if targets is not None:
+        if targets is not None and self.config.loss_chunk_size > 0:
+            # same loss, but the (b, t, vocab_size) logits are never materialized, so none are returned
+            loss = ChunkedCrossEntropy.apply(x.view(-1, x.size(-1)), self.lm_head.weight, targets.view(-1),
+                                             self.config.loss_chunk_size)
+            logits = None
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+        elif all_logits:
+            # e.g. to score several speculated tokens at once
+            logits = self.lm_head(x)
+            loss = None
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
             logits = self.lm_head(x[:, [-1], :])  # note: using list [-1] to preserve the time dim
@@ -198,6 +728,31 @@ class GPT(nn.Module):
 
         return logits, loss
 
+    @staticmethod
+    def _attn_mask(key_mask, t):
+        # causal mask over the keys that hold real tokens, for the last t of the s positions.
+        # a query may always see itself, so that padding rows don't turn into NaNs
+        s = key_mask.size(1)
+        q_slot = torch.arange(s - t, s, device=key_mask.device)[:, None]
+        k_slot = torch.arange(s, device=key_mask.device)[None, :]
+        attn_mask = ((k_slot <= q_slot) & key_mask[:, None, :]) | (k_slot == q_slot)  # (b, t, s)
+        return attn_mask[:, None]  # (b, 1, t, s), broadcast over the heads
+
+    @staticmethod
+    def pad_prompts(prompts, pad_id=0, device=None):
+        """
+        Left-pad a ragged list of token id sequences into a LongTensor idx of shape (b, t)
+        plus a boolean pad_mask of the same shape that is True on the real tokens.
+        """
+        assert all(len(p) > 0 for p in prompts), "empty prompts are not supported"
+        t = max(len(p) for p in prompts)
+        idx = torch.full((len(prompts), t), pad_id, dtype=torch.long)
+        pad_mask = torch.zeros(len(prompts), t, dtype=torch.bool)
+        for i, p in enumerate(prompts):
+            idx[i, t - len(p):] = torch.as_tensor(p, dtype=torch.long)
+            pad_mask[i, t - len(p):] = True
+        return idx.to(device), pad_mask.to(device)
+
     def crop_block_size(self, block_size):
         # model surgery to decrease the block size if necessary
         # e.g. we may load the GPT2 pretrained model checkpoint (block size 1024)
@@ -209,13 +764,76 @@ class GPT(nn.Module):
             if hasattr(block.attn, 'bias'):
                 block.attn.bias = block.attn.bias[:, :, :block_size, :block_size]
 
+    def group_kv_heads(self, n_kv_head):
+        # model surgery to turn multi-head attention into grouped-query attention, e.g. to
+        # uptrain a pretrained GPT2: every group of n_head // n_kv_head consecutive key/value
+        # heads is mean-pooled into the one head the group's queries will share
+        attn = self.transformer.h[0].attn
+        assert attn.n_kv_head == self.config.n_head, "can only group the heads of standard multi-head attention"
+        assert self.config.n_head % n_kv_head == 0
+        C, hs = self.config.n_embd, self.config.n_embd // self.config.n_head
+        group = self.config.n_head // n_kv_head
+        self.config.n_kv_head = n_kv_head
+        for block in self.transformer.h:
+            old = block.attn.c_attn
+            q_w, k_w, v_w = old.weight.detach().split(C, dim=0)
+            pool = lambda w: w.reshape(n_kv_head, group, hs, *w.shape[1:]).mean(dim=1).reshape(n_kv_head * hs, *w.shape[1:])
+            new = nn.Linear(C, C + 2 * n_kv_head * hs, bias=old.bias is not None).to(old.weight)
+            with torch.no_grad():
+                new.weight.copy_(torch.cat([q_w, pool(k_w), pool(v_w)]))
+                if old.bias is not None:
+                    q_b, k_b, v_b = old.bias.detach().split(C)
+                    new.bias.copy_(torch.cat([q_b, pool(k_b), pool(v_b)]))
+            block.attn.c_attn = new
+            block.attn.n_kv_head = n_kv_head
+            block.attn.kv_dim = n_kv_head * hs
+
+    def load_weights(self, state_dict):
+        """
+        load_state_dict that adopts the tensors of state_dict as the parameters instead of
+        copying them over (where torch supports it, >= 2.1), so that memory-mapped weights
+        stay memory-mapped until they are moved to a device. Keys of a compiled model's
+        checkpoint lose their '_orig_mod.' prefix, and the lm_head stays tied to wte.
+        """
+        # fix the keys of the state dictionary :(
+        # honestly no idea how checkpoints sometimes get this prefix, have to debug more
+        unwanted_prefix = '_orig_mod.'
+        state_dict = {k.removeprefix(unwanted_prefix): v for k, v in state_dict.items()}
+        state_dict.setdefault('lm_head.weight', state_dict['transformer.wte.weight'])
+        assign = 'assign' in inspect.signature(self.load_state_dict).parameters
+        missing, unexpected = self.load_state_dict(state_dict, strict=False, **(dict(assign=True) if assign else {}))
+        # the causal mask buffers (slow attention only) are built in __init__, not loaded
+        assert not unexpected, f"unexpected keys: {unexpected}"
+        assert all(k.endswith('.attn.bias') for k in missing), f"missing keys: {missing}"
+        # assigning wte and lm_head one by one unties them
+        self.transformer.wte.weight = self.lm_head.weight
+        # a model built on the meta device still has to materialize the buffers it didn't load
+        for block in self.transformer.h:
+            if hasattr(block.attn, 'bias') and block.attn.bias.is_meta:
+                T = self.config.block_size
+                block.attn.bias = torch.tril(torch.ones(T, T, device=self.lm_head.weight.device)).view(1, 1, T, T)
+
+    @classmethod
+    def from_state_dict(cls, config, state_dict):
+        """
+        A GPT with the weights of state_dict, built on the meta device: no memory is allocated
+        and no random init is run for parameters that load_weights replaces right away. On
+        torch < 2.1, which can't assign tensors as parameters, the model is built normally.
+        """
+        if 'assign' not in inspect.signature(nn.Module.load_state_dict).parameters:
+            model = cls(config)
+        else:
+            with torch.device('meta'):
+                model = cls(config)
+        model.load_weights(state_dict)
+        return model
+
     @classmethod
     def from_pretrained(cls, model_type, override_args=None):
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
         override_args = override_args or {}
-        # only dropout can be overridden see more notes below
-        assert all(k == 'dropout' for k in override_args)
-        from transformers import GPT2LMHeadModel
+        # only dropout and the training-only memory savers can be overridden see more notes below
+        assert all(k in {'dropout', 'loss_chunk_size', 'recompute', 'recompute_every'} for k in override_args)
         print("loading weights from pretrained gpt: %s" % model_type)
 
         # n_layer, n_head and n_embd are determined from model_type
@@ -233,37 +851,13 @@ class GPT(nn.Module):
         if 'dropout' in override_args:
             print(f"overriding dropout rate to {override_args['dropout']}")
             config_args['dropout'] = override_args['dropout']
-        # create a from-scratch initialized minGPT model
+        for k in ['loss_chunk_size', 'recompute', 'recompute_every']:
+            if k in override_args:
+                config_args[k] = override_args[k]
+        # create a minGPT model around the memory-mapped pretrained weights, see weights.py for
+        # the one-time conversion from the huggingface/transformers layout
         config = GPTConfig(**config_args)
-        model = GPT(config)
-        sd = model.state_dict()
-        sd_keys = sd.keys()
-        sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')]  # discard this mask / buffer, not a param
-
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
-
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
-        sd_keys_hf = sd_hf.keys()
-        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')]  # ignore these, just a buffer
-        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')]  # same, just the mask (buffer)
-        transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
-        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
-        # this means that we have to transpose these weights when we import them
-        assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
-        for k in sd_keys_hf:
-            if any(k.endswith(w) for w in transposed):
-                # special treatment for the Conv1D weights we need to transpose
-                assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
-            else:
-                # vanilla copy over the other parameters
-                assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
-
+        model = GPT.from_state_dict(config, gpt2_state_dict(model_type))
         return model
 
     def configure_optimizers(self, weight_decay, learning_rate, betas, device_type):
@@ -292,45 +886,165 @@ class GPT(nn.Module):
 
         return optimizer
 
-    def estimate_mfu(self, fwdbwd_per_iter, dt):
-        """estimate model flops utilization (MFU) in units of A100 bfloat16 peak FLOPS"""
-        # first estimate the number of flops we do per iteration.
-        # see PaLM paper Appendix B as ref: https://arxiv.org/abs/2204.02311
-        N = self.get_num_params()
-        cfg = self.config
-        L, H, Q, T = cfg.n_layer, cfg.n_head, cfg.n_embd//cfg.n_head, cfg.block_size
-        flops_per_token = 6*N + 12*L*H*Q*T
-        flops_per_fwdbwd = flops_per_token * T
-        flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
-        # express our flops throughput as ratio of A100 bfloat16 peak flops
-        flops_achieved = flops_per_iter * (1.0/dt)
-        flops_promised = 312e12  # A100 GPU bfloat16 peak flops is 312 TFLOPS
-        mfu = flops_achieved / flops_promised
-        return mfu
+    def estimate_mfu(self, fwdbwd_per_iter, dt, seq_len=None, peak_flops=312e12):
+        """
+        estimate model flops utilization (MFU) of fwdbwd_per_iter forward + backward passes
+        over sequences of seq_len (default block_size) tokens in dt seconds, in units of
+        peak_flops (default A100 bfloat16 peak). see throughput.py for the flop count, and
+        for the peak of other hardware
+        """
+        T = seq_len or self.config.block_size
+        flops_achieved = flops_per_token(self.config, T) * T * fwdbwd_per_iter / dt
+        return flops_achieved / peak_flops
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, pad_mask=None, kv_cache=None, prefix_cache=None,
+                 top_p=None, min_p=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_kv_cache=True the keys/values of past positions are kept in a KVCache, so
+        each step only forwards the newly sampled token. The samples are the same either way.
+        idx may also be a ragged list of prompts (lists of token ids). These are left-padded
+        and decoded together as one batch, and the completions come back as a list of lists
+        with the padding removed. A left-padded tensor idx needs its pad_mask passed along.
+        An empty kv_cache may be passed in, e.g. a PagedKVCache, instead of a fresh KVCache.
+        With a PrefixCache and a batch of identical prompts (e.g. several samples of one
+        prompt), the prompt prefix is computed once, or not at all if it is cached already.
+        temperature, top_k, top_p and min_p may also be lists with one value per row, see sampling.sample.
         """
+        ragged = isinstance(idx, (list, tuple))
+        if ragged:
+            idx, pad_mask = self.pad_prompts(idx, device=self.lm_head.weight.device)
+            if bool(pad_mask.all()):
+                pad_mask = None  # prompts of equal length need no padding, e.g. samples of one prompt
+        if kv_cache is None and use_kv_cache:
+            kv_cache = KVCache(self.config)
+        if (prefix_cache is not None and kv_cache is not None and pad_mask is None
+                and idx.size(1) <= self.config.block_size and bool((idx == idx[:1]).all())):
+            prompt = idx[0].tolist()
+            prefix_cache.fill(self, prompt)
+            prefix_cache.load(prompt, kv_cache, idx.size(0))
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+            if kv_cache is not None and 0 < kv_cache.pos < self.config.block_size:
+                # the cache holds everything but the last token(s): usually just the one we
+                # sampled last, on the first step whatever a prefix cache didn't have
+                idx_cond = idx[:, kv_cache.pos:]
+                mask_cond = None  # sampled tokens are never padding
+            else:
+                # if the sequence context is growing too long we must crop it at block_size
+                idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+                # once cropping kicks in every position shifts, so the cache has to be rebuilt
+                if kv_cache is not None:
+                    kv_cache.reset()
+                mask_cond = pad_mask[:, -idx_cond.size(1):] if pad_mask is not None else None
             # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+            logits, _ = self(idx_cond, kv_cache=kv_cache, pad_mask=mask_cond)
+            # sample from the logits at the final step, among the top_k / top_p / min_p candidates
+            idx_next = sample(logits[:, -1, :], temperature, top_k, top_p, min_p, real_vocab_size(self.config.vocab_size))
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            if pad_mask is not None:
+                pad_mask = torch.cat((pad_mask, pad_mask.new_ones(pad_mask.size(0), 1)), dim=1)
 
+        if ragged:
+            if pad_mask is None:
+                return idx.tolist()
+            return [row[mask].tolist() for row, mask in zip(idx, pad_mask)]
         return idx
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens=None, temperature=1.0, top_k=None, stride=None, pad_mask=None, kv_cache=None,
+                        top_p=None, min_p=None):
+        """
+        Like generate(), but yields every sampled token (LongTensor of shape (b,1)) as soon as
+        it is sampled, and the sample may grow past block_size without bound
+        (max_new_tokens=None streams forever). Only the last block_size tokens are kept.
+        Once the window is full, its oldest stride tokens are dropped and the rest is
+        re-encoded into the emptied KV cache. With learned absolute positions every cached
+        key/value goes stale when the window shifts, so the shift needs the re-encode, and
+        doing it every stride tokens instead of every token bounds the cost of a step at one
+        cached token forward plus (block_size + 1 - stride) / stride re-encoded tokens on average.
+        stride=1 is generate()'s crop-and-recompute behaviour past block_size.
+        """
+        block_size = self.config.block_size
+        stride = stride or max(1, block_size // 4)
+        assert 0 < stride <= block_size, f"stride must be in [1, {block_size}]"
+        kv_cache = kv_cache if kv_cache is not None else KVCache(self.config)
+        n = 0
+        while max_new_tokens is None or n < max_new_tokens:
+            if idx.size(1) > block_size:
+                # the newest token doesn't fit: slide the window by stride and re-encode what is left
+                idx = idx[:, -(block_size + 1 - stride):]
+                if pad_mask is not None:
+                    pad_mask = pad_mask[:, -idx.size(1):]
+                kv_cache.reset()
+            # on a fresh cache forward the whole window, otherwise just the token sampled last
+            mask_cond = pad_mask if kv_cache.pos == 0 else None
+            logits, _ = self(idx[:, kv_cache.pos:], kv_cache=kv_cache, pad_mask=mask_cond)
+            idx_next = sample(logits[:, -1, :], temperature, top_k, top_p, min_p, real_vocab_size(self.config.vocab_size))
+            idx = torch.cat((idx, idx_next), dim=1)
+            if pad_mask is not None:
+                pad_mask = torch.cat((pad_mask, pad_mask.new_ones(pad_mask.size(0), 1)), dim=1)
+            n += 1
+            yield idx_next
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, draft, max_new_tokens, num_draft=4, temperature=1.0, top_k=None, top_p=None, min_p=None):
+        """
+        Speculative decoding (https://arxiv.org/abs/2211.17192) with a smaller draft GPT that
+        shares the vocabulary, e.g. gpt2 drafting for gpt2-xl. Every round the draft proposes
+        num_draft tokens one at a time, this model scores all of them in a single forward, and
+        rejection sampling keeps a prefix of the proposals plus one token of its own, so the
+        samples follow exactly the distribution generate() samples from. Batch size 1 only.
+        Returns the completed idx and a dict of stats: rounds (= target forwards), proposed
+        and accepted draft tokens.
+        """
+        assert idx.size(0) == 1, "speculative decoding supports batch size 1 only"
+        assert draft.config.vocab_size == self.config.vocab_size, "draft and target must share the vocabulary"
+        max_len = min(self.config.block_size, draft.config.block_size)
+        kv_cache, draft_cache = KVCache(self.config), KVCache(draft.config)
+        stats = {'rounds': 0, 'proposed': 0, 'accepted': 0}
+        n_new = 0
+        # next-token distribution(s) from logits (..., vocab_size), the ones generate() samples from
+        probs = lambda logits: distribution(logits, temperature, top_k, top_p, min_p, real_vocab_size(self.config.vocab_size))
+        # both caches hold a prefix of idx, each forward feeds a model whatever it has not seen yet
+        while n_new < max_new_tokens and idx.size(1) + num_draft <= max_len:
+            start = idx.size(1)
+            k = min(num_draft, max_new_tokens - n_new - 1)  # a round yields up to k + 1 tokens
+            # the draft proposes k tokens
+            seq, q = idx, []
+            for _ in range(k):
+                logits, _ = draft(seq[:, draft_cache.pos:], kv_cache=draft_cache)
+                q.append(probs(logits[:, -1, :]))
+                seq = torch.cat((seq, torch.multinomial(q[-1], num_samples=1)), dim=1)
+            # this model scores them all at once: p[i] is its distribution for seq[start + i]
+            logits, _ = self(seq[:, kv_cache.pos:], kv_cache=kv_cache, all_logits=True)
+            p = probs(logits[0, -(k + 1):, :])  # (k + 1, vocab_size)
+            drafted = seq[0, start:]
+            n_accept = 0
+            if k > 0:
+                # accept proposal i with probability min(1, p(d_i) / q(d_i)), stop at the first rejection
+                q = torch.cat(q)  # (k, vocab_size)
+                i = torch.arange(k, device=idx.device)
+                accept = torch.rand(k, device=idx.device) * q[i, drafted] < p[i, drafted]
+                n_accept = int(accept.cumprod(dim=0).sum())
+            if n_accept < k:
+                # resample the rejected position from the residual max(0, p - q)
+                residual = (p[n_accept] - q[n_accept]).clamp(min=0)
+                idx_next = torch.multinomial(residual / residual.sum(), num_samples=1)
+            else:
+                # all proposals accepted, the last distribution gives a bonus token
+                idx_next = torch.multinomial(p[k], num_samples=1)
+            idx = torch.cat((idx, drafted[None, :n_accept], idx_next[None]), dim=1)
+            kv_cache.truncate(start + n_accept)
+            draft_cache.truncate(start + n_accept)
+            n_new += n_accept + 1
+            stats['rounds'] += 1
+            stats['proposed'] += k
+            stats['accepted'] += n_accept
+        if n_new < max_new_tokens:
+            # out of context: finish with plain decoding, which crops at block_size
+            idx = self.generate(idx, max_new_tokens - n_new, temperature=temperature, top_k=top_k, top_p=top_p, min_p=min_p)
+        return idx, stats
@@ -0,0 +1,160 @@
+"""
+Opt-in per-phase timing of training iterations. Every phase of an iteration (data,
+forward, backward, optimizer step, ...) runs under profiler.phase(name). That records the
+host wall time the phase took and, on cuda, a pair of events around the kernels it
+queued, whose device time is read once the events have completed. Nothing waits for
+the device except report(). When the profiler is off, phase() returns a shared no-op
+context manager and costs next to nothing.
+
+For a closer look, trace windows run a full torch.profiler capture over chosen ranges of
+iterations, e.g. '10:15,2000:2005', each written as a Chrome trace JSON
+(chrome://tracing or https://ui.perfetto.dev) with the phases as labelled ranges.
+"""
+
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import nullcontext
+
+import torch
+
+_NO_PHASE = nullcontext()
+
+
+def parse_windows(spec):
+    # '10:15,2000:2005' -> [(10, 15), (2000, 2005)], iterations start:end with end exclusive
+    windows = []
+    for part in filter(None, spec.split(',')):
+        start, end = part.split(':')
+        windows.append((int(start), int(end)))
+    return windows
+
+
+class _Phase:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.label = torch.profiler.record_function(name) if profiler.trace is not None else None
+
+    def __enter__(self):
+        if self.label is not None:
+            self.label.__enter__()
+        if self.profiler.cuda:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        p = self.profiler
+        p.wall[self.name] += time.perf_counter() - self.t0
+        p.calls[self.name] += 1
+        if p.cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            p.events.append((self.name, self.start, end))
+        if self.label is not None:
+            self.label.__exit__(*exc)
+
+
+class StepProfiler:
+
+    def __init__(self, device, enabled=False, trace_windows='', out_dir='.', rank=0):
+        self.windows = parse_windows(trace_windows)
+        self.enabled = enabled or bool(self.windows)
+        self.cuda = self.enabled and 'cuda' in str(device) and torch.cuda.is_available()
+        self.out_dir = out_dir
+        self.rank = rank
+        self.trace = None  # the torch.profiler capture in progress, if any
+        self.trace_window = None
+        self._reset()
+
+    def _reset(self):
+        self.wall = defaultdict(float)  # seconds per phase
+        self.device = defaultdict(float)  # device seconds per phase, of the resolved events
+        self.calls = defaultdict(int)
+        self.events = deque()  # (phase, start, end) cuda events not resolved yet
+        self.iters = 0
+        self.t_step = None
+        self.step_wall = 0.0
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NO_PHASE
+
+    def step(self, iter_num):
+        """ Call at the start of every iteration, with its number. """
+        if not self.enabled:
+            return
+        t = time.perf_counter()
+        if self.t_step is not None:
+            self.iters += 1
+            self.step_wall += t - self.t_step
+        self.t_step = t
+        self._resolve()
+        if self.trace is not None and iter_num >= self.trace_window[1]:
+            self._stop_trace()
+        if self.trace is None:
+            for start, end in self.windows:
+                if start <= iter_num < end:
+                    self._start_trace((iter_num, end))
+                    break
+
+    def _resolve(self, wait=False):
+        # device time of the phases whose events have completed, oldest first
+        while self.events:
+            name, start, end = self.events[0]
+            if wait:
+                end.synchronize()
+            elif not end.query():
+                break
+            self.events.popleft()
+            self.device[name] += start.elapsed_time(end) / 1000
+
+    def _start_trace(self, window):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(activities=activities)
+        self.trace.__enter__()
+        self.trace_window = window
+
+    def _stop_trace(self):
+        self.trace.__exit__(None, None, None)
+        start, end = self.trace_window
+        path = os.path.join(self.out_dir, f'trace-{start}-{end}-rank{self.rank}.json')
+        self.trace.export_chrome_trace(path)
+        self.trace, self.trace_window = None, None
+        print(f"wrote the profiler trace of iterations {start}-{end} to {path}")
+
+    def report(self):
+        """
+        (table, stats) of the phases since the last report, per iteration, and reset. Call at
+        the end of an iteration. stats is flat, e.g. for wandb:
+        {'profile/forward_wall_ms': ..., 'profile/forward_device_ms': ...}.
+        Waits for the device to finish the phases it has queued.
+        """
+        if self.t_step is not None:  # the iteration that just ended
+            self.iters += 1
+            self.step_wall += time.perf_counter() - self.t_step
+        self._resolve(wait=True)
+        iters = max(self.iters, 1)
+        step_ms = self.step_wall / iters * 1000
+        lines = [f"{'phase':>12} {'calls/iter':>10} {'wall ms/iter':>13} {'device ms/iter':>15} {'% of step':>10}"]
+        stats = {'profile/step_wall_ms': step_ms}
+        for name in self.calls:
+            wall_ms = self.wall[name] / iters * 1000
+            device_ms = self.device[name] / iters * 1000 if self.cuda else float('nan')
+            busy_ms = max(wall_ms, device_ms) if self.cuda else wall_ms
+            lines.append(f"{name:>12} {self.calls[name] / iters:>10.1f} {wall_ms:>13.2f} {device_ms:>15.2f} "
+                         f"{100 * busy_ms / max(step_ms, 1e-9):>9.1f}%")
+            stats[f'profile/{name}_wall_ms'] = wall_ms
+            if self.cuda:
+                stats[f'profile/{name}_device_ms'] = device_ms
+        lines.append(f"{'step':>12} {1:>10.1f} {step_ms:>13.2f} {'':>15} {100:>9.1f}%")
+        self._reset()
+        return '\n'.join(lines), stats
+
+    def close(self):
+        # finish a trace window that is still open, e.g. when training ends inside one
+        if self.trace is not None:
+            self._stop_trace()
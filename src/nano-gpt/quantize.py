@@ -0,0 +1,183 @@
+"""
+Weight-only quantization of a GPT for inference.
+int8: one float scale per output channel. int4: symmetric, one scale per group of
+group_size input features, two weights packed per byte. Activations stay in floating
+point, so the linears read 2-8x fewer weight bytes. The float weight is never built as a
+whole: int8 on the cpu goes through torch's weight-only int8 matmul kernel, everything else
+is dequantized one cache-sized tile of output channels at a time, right before its matmul.
+The tied token embedding reads its rows straight from the quantized lm_head.
+
+A quantized model is saved with save_quantized and loaded back with load_quantized,
+without ever materializing the float weights.
+"""
+
+import math
+from dataclasses import asdict
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from model import GPTConfig, GPT
+
+TILE_ELEMENTS = 2**18  # float weights dequantized at a time (1MiB in float32), small enough to stay in cache
+_nibble_tables = {}  # (device, dtype) -> (256, 2) table, see _nibbles
+
+
+def _tiled_linear(x, out_features, tile_rows, dequantize):
+    # F.linear(x, W) for the W that dequantize(start, end) returns tile by tile as rows start..end-1
+    return torch.cat([F.linear(x, dequantize(i, min(i + tile_rows, out_features)))
+                      for i in range(0, out_features, tile_rows)], dim=-1)
+
+
+def _nibbles(device, dtype):
+    # byte -> its (low, high) nibble as signed int4 weights, i.e. minus the offset of 8
+    key = (str(device), dtype)
+    if key not in _nibble_tables:
+        b = torch.arange(256, device=device)
+        _nibble_tables[key] = torch.stack(((b & 0xF) - 8, (b >> 4) - 8), dim=-1).to(dtype)
+    return _nibble_tables[key]
+
+
+class Int8Linear(nn.Module):
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('weight', torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer('scales', torch.ones(out_features))
+        self.register_buffer('bias', torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear):
+        q = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        w = linear.weight.detach().float()
+        scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127
+        q.weight.copy_(torch.round(w / scales[:, None]).clamp(-127, 127).to(torch.int8))
+        q.scales.copy_(scales)
+        if linear.bias is not None:
+            q.bias.copy_(linear.bias.detach())
+        return q.to(linear.weight.device)
+
+    def dequantize_rows(self, idx):
+        # float rows idx of the weight, e.g. for a tied embedding
+        return self.weight[idx].float() * self.scales[idx].unsqueeze(-1)
+
+    def forward(self, x):
+        if x.device.type == 'cpu' and hasattr(torch, '_weight_int8pack_mm'):
+            # the kernel reads the int8 weight directly and applies the per channel scales
+            shape = x.shape
+            y = torch._weight_int8pack_mm(x.reshape(-1, shape[-1]).contiguous(), self.weight, self.scales.to(x.dtype))
+            y = y.view(*shape[:-1], self.out_features)
+        else:
+            tile_rows = max(1, TILE_ELEMENTS // self.in_features)
+            y = _tiled_linear(x, self.out_features, tile_rows,
+                              lambda i, j: self.weight[i:j].to(x.dtype) * self.scales[i:j, None].to(x.dtype))
+        if self.bias is not None:
+            y = y + self.bias.to(x.dtype)
+        return y
+
+
+class Int4Linear(nn.Module):
+
+    def __init__(self, in_features, out_features, bias=True, group_size=128):
+        super().__init__()
+        # the group size has to divide in_features, e.g. 128 becomes 64 for gpt2-xl's 1600
+        group_size = math.gcd(in_features, group_size)
+        assert group_size % 2 == 0, f"in_features {in_features} can't be split into even groups"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer('weight', torch.zeros(out_features, in_features // 2, dtype=torch.uint8))
+        self.register_buffer('scales', torch.ones(out_features, in_features // group_size))
+        self.register_buffer('bias', torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear, group_size=128):
+        q = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, group_size=group_size)
+        w = linear.weight.detach().float().view(q.out_features, -1, q.group_size)
+        scales = w.abs().amax(dim=2).clamp(min=1e-8) / 7
+        w = torch.round(w / scales[..., None]).clamp(-8, 7).to(torch.int16) + 8  # 0..15
+        w = w.view(q.out_features, q.in_features)
+        q.weight.copy_((w[:, 0::2] | (w[:, 1::2] << 4)).to(torch.uint8))
+        q.scales.copy_(scales)
+        if linear.bias is not None:
+            q.bias.copy_(linear.bias.detach())
+        return q.to(linear.weight.device)
+
+    def _dequantize(self, packed, scales, dtype=torch.float32):
+        # packed (..., in_features // 2) uint8 and scales (..., n_groups) -> (..., in_features) of dtype.
+        # a lookup of both nibbles per byte, then the scale of each group
+        w = _nibbles(packed.device, dtype)[packed.int()]  # (..., in_features // 2, 2)
+        w = w.view(*packed.shape[:-1], -1, self.group_size) * scales.to(dtype).unsqueeze(-1)
+        return w.flatten(-2)
+
+    def dequantize_rows(self, idx):
+        return self._dequantize(self.weight[idx], self.scales[idx])
+
+    def forward(self, x):
+        tile_rows = max(1, TILE_ELEMENTS // self.in_features)
+        y = _tiled_linear(x, self.out_features, tile_rows,
+                          lambda i, j: self._dequantize(self.weight[i:j], self.scales[i:j], x.dtype))
+        if self.bias is not None:
+            y = y + self.bias.to(x.dtype)
+        return y
+
+
+class QuantizedEmbedding(nn.Module):
+    """Token embedding that dequantizes rows of the (tied) quantized lm_head on lookup."""
+
+    def __init__(self, head):
+        super().__init__()
+        self.head = [head]  # in a list so it is not registered twice in the state_dict
+
+    def forward(self, idx):
+        return self.head[0].dequantize_rows(idx)
+
+
+def quantize_model(model, mode='int8', group_size=128, from_weights=True):
+    """
+    Swap every nn.Linear of the transformer blocks and the lm_head of a GPT for its int8 or
+    int4 counterpart, in place. from_weights=False only builds the quantized structure (with
+    empty weights), e.g. to load_state_dict a saved quantized model into.
+    """
+    assert mode in {'int8', 'int4'}
+    def convert(linear):
+        if from_weights:
+            return Int8Linear.from_linear(linear) if mode == 'int8' else Int4Linear.from_linear(linear, group_size)
+        bias = linear.bias is not None
+        if mode == 'int8':
+            return Int8Linear(linear.in_features, linear.out_features, bias)
+        return Int4Linear(linear.in_features, linear.out_features, bias, group_size)
+    for block in model.transformer.h:
+        for parent in (block.attn, block.mlp):
+            for name, child in list(parent.named_children()):
+                if isinstance(child, nn.Linear):
+                    setattr(parent, name, convert(child))
+    model.lm_head = convert(model.lm_head)
+    model.transformer.wte = QuantizedEmbedding(model.lm_head)
+    model.quantization = dict(mode=mode, group_size=group_size)
+    model.config.loss_chunk_size = 0  # the fused chunked loss needs a float lm_head weight
+    return model
+
+
+def save_quantized(model, path, config=None):
+    # config: the training config of the source checkpoint, lets sample.py find the dataset's meta.pkl
+    torch.save({
+        'model_args': asdict(model.config),
+        'quantization': model.quantization,
+        'model': model.state_dict(),
+        'config': config or {},
+    }, path)
+
+
+def load_quantized(path, device='cpu'):
+    checkpoint = torch.load(path, map_location=device)
+    # init on the meta device: every weight is about to be replaced anyway
+    with torch.device('meta'):
+        model = GPT(GPTConfig(**checkpoint['model_args']))
+    quantize_model(model, from_weights=False, **checkpoint['quantization'])
+    model.to_empty(device=device)
+    model.load_state_dict(checkpoint['model'])
+    return model, checkpoint
@@ -2,24 +2,40 @@
 Sample from a trained model
 """
 import os
+import time
 import pickle
 from contextlib import nullcontext
 import torch
 import tiktoken
-from model import GPTConfig, GPT
+from model import GPTConfig, GPT, KVPool, PagedKVCache, PrefixCache
+from quantize import quantize_model, load_quantized
+from weights import load_checkpoint, peak_rss
+from charcodec import CharCodec
 
 # -----------------------------------------------------------------------------
-init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
-out_dir = 'out' # ignored if init_from is not 'resume'
+init_from = 'resume' # either 'resume' (from an out_dir), 'quantized' (ckpt_quant.pt in out_dir, see bench_quantize.py) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is not 'resume' or 'quantized'
 start = "\n" # or "<|endoftext|>" or etc. Can also specify a file, use as: "FILE:prompt.txt"
-num_samples = 10 # number of samples to draw
+start_sep = '' # if set, split start into several prompts on this separator (e.g. '\n\n')
+num_samples = 10 # number of samples to draw per prompt
 max_new_tokens = 500 # number of tokens generated in each sample
 temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+top_p = 0.0 # if > 0, retain only the fewest most likely tokens whose probabilities add up to top_p (nucleus sampling)
+min_p = 0.0 # if > 0, retain only the tokens at least min_p times as likely as the most likely one
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+quantize = '' # 'int8' or 'int4' for weight-only quantized linears, '' to keep the float weights
+quantize_group_size = 128 # int4 only: number of input features sharing one scale
+use_kv_cache = True # keep past keys/values around so each step only forwards the newest token
+paged_kv_block = 0 # if > 0, page the KV cache in blocks of this many positions and report its memory use
+prefix_cache_mb = 0 # if > 0, compute the keys/values of each prompt prefix once and share them across samples and prompts
+draft_model = '' # a smaller gpt2 variant (e.g. 'gpt2' for init_from='gpt2-xl') to enable speculative decoding
+num_draft = 4 # number of tokens the draft model proposes per speculative round
+stream = False # print each token as it is sampled, one sample at a time, with no limit on the length (max_new_tokens=-1 streams until interrupted)
+stream_stride = 0 # when streaming past block_size, re-encode the context every this many tokens (0: block_size // 4)
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -32,30 +48,32 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # model
+t_load = time.time()
 if init_from == 'resume':
     # init from a model saved in a specific directory
     ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
+    checkpoint = load_checkpoint(ckpt_path) # memory-mapped, on the cpu until the model is moved
     gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model = GPT.from_state_dict(gptconf, checkpoint['model'])
+elif init_from == 'quantized':
+    # init from a model that was quantized and saved already
+    model, checkpoint = load_quantized(os.path.join(out_dir, 'ckpt_quant.pt'), device)
 elif init_from.startswith('gpt2'):
     # init from a given GPT-2 model
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+if quantize:
+    assert init_from != 'quantized', "the checkpoint is quantized already"
+    model = quantize_model(model, quantize, quantize_group_size)
 
 model.eval()
 model.to(device)
+print(f"loaded the model in {time.time() - t_load:.2f}s, peak RSS {peak_rss() / 2**30:.2f}GiB")
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
 
 # look for the meta pickle in case it is available in the dataset folder
 load_meta = False
-if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
+if init_from in ('resume', 'quantized') and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
     meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
     load_meta = os.path.exists(meta_path)
 if load_meta:
@@ -63,9 +81,9 @@ if load_meta:
     with open(meta_path, 'rb') as f:
         meta = pickle.load(f)
     # TODO want to make this more general to arbitrary encoder/decoder schemes
-    stoi, itos = meta['stoi'], meta['itos']
-    encode = lambda s: [stoi[c] for c in s]
-    decode = lambda l: ''.join([itos[i] for i in l])
+    codec = CharCodec.from_meta(meta)
+    encode = lambda s: codec.encode(s).tolist()
+    decode = lambda l: codec.decode(l)
 else:
     # ok let's assume gpt-2 encodings by default
     print("No meta.pkl found, assuming GPT-2 encodings...")
@@ -77,13 +95,92 @@ else:
 if start.startswith('FILE:'):
     with open(start[5:], 'r', encoding='utf-8') as f:
         start = f.read()
-start_ids = encode(start)
-x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
+prompts = start.split(start_sep) if start_sep else [start]
+start_ids = [encode(p) for p in prompts]
+
+kv_pool = KVPool(model.config, block_len=paged_kv_block) if use_kv_cache and paged_kv_block > 0 else None
+prefix_cache = PrefixCache(model.config, max_bytes=prefix_cache_mb * 2**20) if use_kv_cache and prefix_cache_mb > 0 else None
+
+sampling_args = dict(temperature=temperature, top_k=top_k, top_p=top_p or None, min_p=min_p or None)
 
 # run generation
-with torch.no_grad():
-    with ctx:
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
-            print('---------------')
\ No newline at end of file
+if stream:
+    # one sample at a time, written to stdout token by token. the context window slides past
+    # block_size every stream_stride tokens, so samples can be arbitrarily long
+    kv_cache = PagedKVCache(kv_pool, model.config) if kv_pool is not None else None
+    n_tokens, t0 = 0, time.time()
+    with torch.no_grad():
+        with ctx:
+            for ids in start_ids:
+                x = torch.tensor(ids, dtype=torch.long, device=device)[None, ...]
+                for k in range(num_samples):
+                    print(decode(ids), end='', flush=True)
+                    pending = [] # tokens that don't decode to whole characters yet
+                    for idx_next in model.generate_stream(x, max_new_tokens if max_new_tokens >= 0 else None, **sampling_args,
+                                                          stride=stream_stride or None, kv_cache=kv_cache):
+                        pending.append(idx_next.item())
+                        text = decode(pending)
+                        if not text.endswith('\ufffd'): # e.g. the first byte of a multi-byte character
+                            print(text, end='', flush=True)
+                            pending = []
+                        n_tokens += 1
+                    print(decode(pending))
+                    print('---------------')
+                    if kv_cache is not None:
+                        kv_cache.reset()
+    dt = time.time() - t0
+    print(f"streamed {n_tokens} tokens, {n_tokens / dt:.2f} tokens/sec")
+elif draft_model:
+    # speculative decoding, one sample at a time: the draft model proposes tokens, the model above verifies them
+    draft = GPT.from_pretrained(draft_model, dict(dropout=0.0))
+    draft.eval()
+    draft.to(device)
+    stats = {'rounds': 0, 'proposed': 0, 'accepted': 0}
+    n_tokens, t0 = 0, time.time()
+    with torch.no_grad():
+        with ctx:
+            for ids in start_ids:
+                x = torch.tensor(ids, dtype=torch.long, device=device)[None, ...]
+                for k in range(num_samples):
+                    y, round_stats = model.generate_speculative(x, draft, max_new_tokens, num_draft=num_draft, **sampling_args)
+                    stats = {key: stats[key] + round_stats[key] for key in stats}
+                    n_tokens += y.size(1) - x.size(1)
+                    print(decode(y[0].tolist()))
+                    print('---------------')
+    dt = time.time() - t0
+    print(f"speculative decoding: {n_tokens / dt:.2f} tokens/sec, acceptance rate "
+          f"{stats['accepted'] / max(stats['proposed'], 1) * 100:.1f}%, "
+          f"{(stats['accepted'] + stats['rounds']) / max(stats['rounds'], 1):.2f} tokens per forward of {init_from} "
+          f"(an upper bound on the speedup, see bench_generate.py for a measured one)")
+elif prefix_cache is not None:
+    # one batch of num_samples identical rows per prompt: the prompt prefix is computed once
+    # and prompts that share a beginning (e.g. a long FILE: preamble) reuse it
+    with torch.no_grad():
+        with ctx:
+            for ids in start_ids:
+                kv_cache = PagedKVCache(kv_pool, model.config) if kv_pool is not None else None
+                ys = model.generate([ids] * num_samples, max_new_tokens, **sampling_args,
+                                    kv_cache=kv_cache, prefix_cache=prefix_cache)
+                if kv_cache is not None:
+                    kv_cache.free()
+                for y in ys:
+                    print(decode(y))
+                    print('---------------')
+    stats = prefix_cache.stats()
+    print(f"prefix cache: {stats['entries']} chunks, {stats['bytes']/2**20:.1f}/{stats['max_bytes']/2**20:.0f}MiB, "
+          f"hit rate {stats['hit_rate']*100:.1f}% of prompts, {stats['token_hit_rate']*100:.1f}% of prompt tokens")
+else:
+    # all samples of all prompts decode together as one left-padded batch
+    kv_cache = PagedKVCache(kv_pool, model.config) if kv_pool is not None else None
+    with torch.no_grad():
+        with ctx:
+            ys = model.generate([ids for ids in start_ids for _ in range(num_samples)], max_new_tokens,
+                                **sampling_args, use_kv_cache=use_kv_cache, kv_cache=kv_cache)
+            for y in ys:
+                print(decode(y))
+                print('---------------')
+if kv_pool is not None:
+    stats = kv_pool.stats()
+    print(f"paged KV cache: {stats['tokens']:,} positions in {stats['blocks_used']}/{stats['blocks_allocated']} blocks "
+          f"of {stats['block_len']} (peak {stats['blocks_peak']}), occupancy {stats['occupancy']*100:.1f}%, "
+          f"fragmentation {stats['fragmentation']*100:.1f}%, {stats['bytes_allocated']/2**20:.1f}MiB allocated")
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+Batched next-token sampling with temperature, top-k, top-p (nucleus) and min-p.
+Every parameter is either one value for the whole batch or one value per row (a list,
+with None to disable the filter for that row, or a tensor), so rows of a served batch
+can each sample their own way.
+
+The filters only ever look at the candidates: the top max(top_k) logits when top-k is on,
+else the top MAX_CANDIDATES logits, as long as top-p or min-p cut every row off within
+them (all logits sorted once otherwise). The softmax, the nucleus cumsum and the
+multinomial draw all run over those candidates, not the full vocabulary. Logits past
+vocab_size, e.g. the padding train.py adds to round GPT-2's 50257 tokens up to 50304, are
+sliced off before anything else and can never be sampled.
+"""
+
+import torch
+from torch.nn import functional as F
+
+GPT2_VOCAB_SIZE = 50257  # real tokens of the GPT-2 tokenizer
+GPT2_PADDED_VOCAB_SIZE = 50304  # what train.py rounds it up to, see model_args['vocab_size']
+MAX_CANDIDATES = 1024  # top-p and min-p without top-k look at this many candidates first
+
+
+def real_vocab_size(vocab_size):
+    # number of logits that correspond to actual tokens for a model with vocab_size outputs
+    return GPT2_VOCAB_SIZE if vocab_size == GPT2_PADDED_VOCAB_SIZE else vocab_size
+
+
+def _rows(x, n, off, dtype, device):
+    # a sampling parameter as a (n,) tensor, None if it is disabled for every row.
+    # off is the value that disables the filter, for rows that pass None
+    if x is None:
+        return None
+    if isinstance(x, torch.Tensor):
+        return x.to(device=device, dtype=dtype).expand(n)
+    if not isinstance(x, (list, tuple)):
+        x = [x] * n
+    if all(v is None for v in x):
+        return None
+    return torch.tensor([off if v is None else v for v in x], dtype=dtype, device=device)
+
+
+def _candidates(logits, temperature=1.0, top_k=None, top_p=None, min_p=None, vocab_size=None):
+    # logits (B, V) -> (ids, probs): the surviving candidates of every row and their (not
+    # renormalized) probabilities, both (B, n). ids is None if nothing is filtered at all
+    if vocab_size is not None:
+        logits = logits[:, :vocab_size]  # the one place padded vocab slots are masked
+    B, V = logits.shape
+    device = logits.device
+    logits = logits.float()
+    temps = _rows(temperature, B, 1.0, torch.float32, device)
+    ps = _rows(top_p, B, 1.0, torch.float32, device)
+    min_ps = _rows(min_p, B, 0.0, torch.float32, device)
+    ks = _rows(top_k, B, V, torch.long, device)
+    if ks is None and ps is None and min_ps is None:
+        return None, F.softmax(logits / temps[:, None], dim=-1)
+    if ks is None and V > MAX_CANDIDATES:
+        # top-p / min-p alone: the most likely candidates nearly always hold every token the
+        # filters keep. probabilities are over the full vocabulary, via its logsumexp. checking
+        # that the filters cut every row off within the candidates costs one sync
+        vals, ids = torch.topk(logits, MAX_CANDIDATES)
+        lse = torch.logsumexp(logits / temps[:, None], dim=-1, keepdim=True)
+        probs = torch.exp(vals / temps[:, None] - lse)
+        cut = torch.zeros(B, dtype=torch.bool, device=device)
+        if ps is not None:
+            cut |= probs.sum(dim=-1) >= ps  # the rest lies past the nucleus
+        if min_ps is not None:
+            cut |= probs[:, -1] < min_ps * probs[:, 0]  # the rest is below the min-p threshold
+        if bool(cut.all()):
+            return ids, _filter(probs, ps, min_ps)
+    # the candidates, most likely first. k_max comes from the python values where possible,
+    # so that a batch on the gpu doesn't have to sync here
+    if ks is None:
+        k_max = V
+    elif isinstance(top_k, torch.Tensor):
+        k_max = int(top_k.max())
+    elif isinstance(top_k, (list, tuple)):
+        k_max = V if None in top_k else max(top_k)
+    else:
+        k_max = top_k
+    k_max = min(k_max, V)
+    if k_max < V:
+        vals, ids = torch.topk(logits, k_max)
+    else:
+        vals, ids = torch.sort(logits, dim=-1, descending=True)
+    if ks is not None and not isinstance(top_k, int):
+        # rows asking for fewer than k_max candidates
+        vals = vals.masked_fill(torch.arange(k_max, device=device)[None, :] >= ks[:, None], -float('Inf'))
+    probs = F.softmax(vals / temps[:, None], dim=-1)
+    return ids, _filter(probs, ps, min_ps)
+
+
+def _filter(probs, ps, min_ps):
+    # zero the candidates (B, n), most likely first, that top-p or min-p drop.
+    # the most likely candidate always survives both
+    if ps is not None:
+        # nucleus: the fewest candidates whose probabilities add up to top_p
+        probs = probs.masked_fill(probs.cumsum(dim=-1) - probs >= ps[:, None], 0.0)
+    if min_ps is not None:
+        # drop candidates less likely than min_p times the most likely one
+        probs = probs.masked_fill(probs < min_ps[:, None] * probs[:, :1], 0.0)
+    return probs
+
+
+def sample(logits, temperature=1.0, top_k=None, top_p=None, min_p=None, vocab_size=None):
+    """
+    Sample one token per row of logits (B, V), returns (B, 1) token ids.
+    top_k keeps the k most likely tokens, top_p the fewest most likely tokens whose
+    probabilities add up to top_p, min_p the tokens at least min_p times as likely as
+    the most likely one. None disables a filter. vocab_size: only the first vocab_size
+    logits are real tokens.
+    """
+    ids, probs = _candidates(logits, temperature, top_k, top_p, min_p, vocab_size)
+    choice = torch.multinomial(probs, num_samples=1)  # multinomial doesn't need the probs to sum to 1
+    return ids.gather(1, choice) if ids is not None else choice
+
+
+def distribution(logits, temperature=1.0, top_k=None, top_p=None, min_p=None, vocab_size=None):
+    """
+    The full next-token distribution (..., V) that sample() draws from, e.g. to compare
+    two models' distributions in speculative decoding. Filtered tokens get probability 0.
+    """
+    shape = logits.shape
+    logits = logits.reshape(-1, shape[-1])
+    ids, probs = _candidates(logits, temperature, top_k, top_p, min_p, vocab_size)
+    probs = probs / probs.sum(dim=-1, keepdim=True)
+    out = torch.zeros(logits.shape, dtype=probs.dtype, device=logits.device)
+    if ids is not None:
+        out.scatter_(1, ids, probs)
+    else:
+        out[:, :probs.size(1)] = probs
+    return out.view(shape)
@@ -0,0 +1,365 @@
+"""
+Serve a trained model over HTTP with continuous batching.
+The checkpoint is loaded once. A single scheduler thread owns the model and keeps one
+running decode batch: every step it admits newly arrived requests into the batch and
+evicts the finished ones, so concurrent requests share every forward pass.
+With paged_kv_block > 0 all sequences share one KVPool and GET /stats reports its
+occupancy and fragmentation, to help size max_batch_size for a host. With a prefix
+cache, requests that start like an earlier one (e.g. a shared system prompt) only
+prefill what is new, and /stats reports its hit rate and memory use.
+
+$ python serve.py --out_dir=out-shakespeare-char --device=cpu
+$ curl -N localhost:8000/generate -d '{"prompt": "ROMEO:", "max_new_tokens": 100, "temperature": 0.8, "top_k": 200}'
+
+POST /generate takes a JSON body with prompt and optional max_new_tokens, temperature,
+top_k, top_p and min_p. The response streams newline-delimited JSON, one {"token": id, "text": str} object
+per sampled token and a final {"done": true, "n_tokens": n}, or {"error": str, "n_tokens": n}
+if the request could not be finished (e.g. it needs more KV blocks than max_kv_blocks).
+"""
+import os
+import json
+import queue
+import pickle
+import threading
+from collections import deque
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+import tiktoken
+from model import GPTConfig, GPT, KVCache, KVPool, PagedKVCache, PrefixCache
+from weights import load_checkpoint
+from sampling import sample, real_vocab_size
+from charcodec import CharCodec
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is not 'resume'
+host = '127.0.0.1'
+port = 8000
+max_batch_size = 32 # max number of sequences decoded together
+paged_kv_block = 16 # page the KV cache in blocks of this many positions, 0 for one dense buffer per batch
+max_kv_blocks = 0 # cap on the number of paged KV blocks, 0 for no cap
+prefix_cache_mb = 256 # memory budget for keys/values of prompt prefixes shared across requests, 0 to disable
+max_new_tokens = 200 # per-request defaults, a request may override these
+temperature = 0.8
+top_k = 200
+top_p = 0.0 # nucleus sampling, 0.0 to disable
+min_p = 0.0 # keep tokens at least min_p times as likely as the most likely one, 0.0 to disable
+seed = 1337
+device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+torch.cuda.manual_seed(seed)
+torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+# model
+if init_from == 'resume':
+    # init from a model saved in a specific directory
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    checkpoint = load_checkpoint(ckpt_path)
+    gptconf = GPTConfig(**checkpoint['model_args'])
+    model = GPT.from_state_dict(gptconf, checkpoint['model'])
+elif init_from.startswith('gpt2'):
+    # init from a given GPT-2 model
+    model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+
+model.eval()
+model.to(device)
+if compile:
+    model = torch.compile(model) # requires PyTorch 2.0 (optional)
+block_size = model.config.block_size
+
+# look for the meta pickle in case it is available in the dataset folder
+load_meta = False
+if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
+    meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
+    load_meta = os.path.exists(meta_path)
+if load_meta:
+    print(f"Loading meta from {meta_path}...")
+    with open(meta_path, 'rb') as f:
+        meta = pickle.load(f)
+    codec = CharCodec.from_meta(meta)
+    encode = lambda s: codec.encode(s).tolist()
+    decode = lambda l: codec.decode(l)
+else:
+    print("No meta.pkl found, assuming GPT-2 encodings...")
+    enc = tiktoken.get_encoding("gpt2")
+    encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
+    decode = lambda l: enc.decode(l)
+
+# -----------------------------------------------------------------------------
+
+class Request:
+    """
+    One generation request. The scheduler pushes sampled token ids to out, then None.
+    If the request fails, error is set before the None.
+    """
+
+    def __init__(self, ids, max_new_tokens, temperature, top_k, top_p=None, min_p=None):
+        self.ids = ids[-block_size:]
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = int(top_k) if top_k is not None else None
+        self.top_p = float(top_p) if top_p else None
+        self.min_p = float(min_p) if min_p else None
+        self.n_generated = 0
+        self.cancelled = False # set when the client goes away
+        self.error = None
+        self.kv_blocks = 0 # KV blocks reserved for it, see Scheduler.fit
+        self.out = queue.Queue()
+
+
+def sample_rows(logits, reqs):
+    # sample one token per row of logits (B, vocab_size), each row with its own request's parameters
+    return sample(logits, [r.temperature for r in reqs], [r.top_k for r in reqs], [r.top_p for r in reqs],
+                  [r.min_p for r in reqs], real_vocab_size(logits.size(-1))) # (B, 1)
+
+
+class Scheduler(threading.Thread):
+    """
+    Continuous batching: row i of the running KVCache belongs to active[i]. Newly arrived
+    requests are prefilled together and folded into the batch before every decode step,
+    and finished (or cancelled) rows are evicted right after it. With a capped KVPool,
+    requests wait in held until the pool has blocks for every token they can reach.
+    """
+
+    def __init__(self, model, max_batch_size, kv_pool=None, prefix_cache=None):
+        super().__init__(daemon=True)
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.kv_pool = kv_pool
+        self.prefix_cache = prefix_cache
+        self.pending = queue.Queue()
+        self.held = deque() # taken from pending, waiting for KV blocks
+        self.active = []
+        self.admitting = [] # the requests admit() is prefilling
+        self.prefill_cache = None # the KV cache of a prefill in flight, not joined yet
+        self.kv_cache = None
+        self.last = None # (B, 1) the tokens sampled last step, not yet in the cache
+
+    def submit(self, req):
+        self.pending.put(req)
+
+    def run(self):
+        while True:
+            try:
+                self.admit()
+                if self.active:
+                    self.step()
+            except Exception as e:
+                # e.g. a forward that ran out of memory: end the requests in flight, keep serving
+                self.abort(f"{type(e).__name__}: {e}")
+
+    @torch.no_grad()
+    def admit(self):
+        new = []
+        while len(self.active) + len(new) < self.max_batch_size:
+            if self.held:
+                new.append(self.held.popleft())
+                continue
+            try:
+                # sleep here only if there is nothing at all to do
+                new.append(self.pending.get(block=not self.active and not new))
+            except queue.Empty:
+                break
+        new = self.fit([r for r in new if not r.cancelled])
+        if not new:
+            return
+        self.admitting = new
+        first = len(self.active)
+        if self.prefix_cache is None:
+            # prefill the newcomers together
+            idx, pad_mask = GPT.pad_prompts([r.ids for r in new], device=device)
+            kv_cache = self.prefill_cache = self.new_cache()
+            with ctx:
+                logits, _ = self.model(idx, kv_cache=kv_cache, pad_mask=pad_mask)
+            self.join(kv_cache, sample_rows(logits[:, -1, :], new))
+        else:
+            # prefill the newcomers one by one, each only forwards what the prefix cache lacks
+            for r in new:
+                kv_cache = self.prefill_cache = self.new_cache()
+                with ctx:
+                    self.prefix_cache.fill(self.model, r.ids)
+                    m = self.prefix_cache.load(r.ids, kv_cache)
+                    idx = torch.tensor(r.ids[m:], dtype=torch.long, device=device)[None, ...]
+                    logits, _ = self.model(idx, kv_cache=kv_cache)
+                self.join(kv_cache, sample_rows(logits[:, -1, :], [r]))
+        self.active += new
+        self.admitting = []
+        self.emit(self.last[first:], first)
+
+    def fit(self, new):
+        # the leading newcomers the KV pool has blocks for. every row reserves the blocks for its
+        # prompt and all the tokens it may generate, so a running row never finds the pool dry.
+        # the others are held back, in order, until finished rows hand their blocks back
+        if self.kv_pool is None or self.kv_pool.max_blocks is None:
+            return new
+        bl = self.kv_pool.block_len
+        free = self.kv_pool.available()
+        if self.kv_cache is not None:
+            # what the running rows have reserved and not taken yet
+            taken = [-(-L // bl) for L in self.kv_cache.lengths().tolist()]
+            free -= sum(max(r.kv_blocks - n, 0) for r, n in zip(self.active, taken))
+        fits = []
+        for i, r in enumerate(new):
+            need = -(-min(len(r.ids) + r.max_new_tokens, block_size) // bl)
+            if need > self.kv_pool.max_blocks:
+                self.fail([r], f"the request needs {need} KV blocks, max_kv_blocks is {self.kv_pool.max_blocks}")
+            elif need > free:
+                self.held.extendleft(reversed(new[i:]))
+                break
+            else:
+                free -= need
+                r.kv_blocks = need
+                fits.append(r)
+        return fits
+
+    def fail(self, reqs, error):
+        for req in reqs:
+            req.error = error
+            req.out.put(None)
+
+    def abort(self, error):
+        # end every request in flight with error and hand all their KV blocks back
+        print(f"scheduler: {error}, ending {len(self.active) + len(self.admitting)} requests")
+        if self.kv_pool is not None:
+            for kv_cache in (self.kv_cache, self.prefill_cache):
+                if kv_cache is not None:
+                    kv_cache.free()
+        self.fail(self.active + self.admitting, error)
+        self.active, self.admitting = [], []
+        self.kv_cache, self.prefill_cache, self.last = None, None, None
+
+    def new_cache(self):
+        if self.kv_pool is not None:
+            return PagedKVCache(self.kv_pool, self.model.config)
+        return KVCache(self.model.config)
+
+    def join(self, kv_cache, idx_next):
+        # fold freshly prefilled rows into the running batch
+        if self.kv_cache is None:
+            self.kv_cache, self.last = kv_cache, idx_next
+        else:
+            self.kv_cache.extend(kv_cache)
+            self.last = torch.cat((self.last, idx_next))
+        self.prefill_cache = None
+
+    @torch.no_grad()
+    def step(self):
+        if self.kv_cache.pos == self.kv_cache.max_len:
+            # every live row still has room (see emit), so some leading slots are all padding
+            self.kv_cache.compact()
+        with ctx:
+            logits, _ = self.model(self.last, kv_cache=self.kv_cache)
+        self.last = sample_rows(logits[:, -1, :], self.active)
+        self.emit(self.last)
+
+    def emit(self, idx_next, first=0):
+        # stream out the new tokens of rows first, first+1, ... and evict the rows that are done.
+        # rows that already hold block_size tokens can't take another position and are done too
+        idx_next = idx_next[:, 0].tolist()
+        lengths = self.kv_cache.lengths().tolist()
+        done = set()
+        for i, tok in enumerate(idx_next, start=first):
+            req = self.active[i]
+            req.n_generated += 1
+            req.out.put(tok)
+            if req.cancelled or req.n_generated >= req.max_new_tokens or lengths[i] >= block_size:
+                req.out.put(None)
+                done.add(i)
+        if not done:
+            return
+        keep = [i for i in range(len(self.active)) if i not in done]
+        self.active = [self.active[i] for i in keep]
+        if not keep:
+            self.kv_cache.keep_rows([]) # hands paged blocks back to the pool
+            self.kv_cache, self.last = None, None
+            return
+        rows = torch.tensor(keep, dtype=torch.long, device=self.last.device)
+        self.kv_cache.keep_rows(rows)
+        self.last = self.last[rows]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # needed for chunked transfer encoding
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        stats = {'active': len(scheduler.active), 'pending': scheduler.pending.qsize() + len(scheduler.held)}
+        if scheduler.kv_pool is not None:
+            stats['kv_pool'] = scheduler.kv_pool.stats()
+        if scheduler.prefix_cache is not None:
+            stats['prefix_cache'] = scheduler.prefix_cache.stats()
+        data = json.dumps(stats).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            req = Request(encode(body['prompt']),
+                          int(body.get('max_new_tokens', max_new_tokens)),
+                          float(body.get('temperature', temperature)),
+                          body.get('top_k', top_k),
+                          body.get('top_p', top_p),
+                          body.get('min_p', min_p))
+            assert len(req.ids) > 0, "empty prompt"
+            assert req.max_new_tokens > 0, "max_new_tokens must be positive"
+            assert req.temperature > 0, "temperature must be positive"
+            assert req.top_k is None or req.top_k > 0, "top_k must be positive"
+            assert req.top_p is None or 0 < req.top_p <= 1, "top_p must be in (0, 1]"
+            assert req.min_p is None or 0 < req.min_p <= 1, "min_p must be in (0, 1]"
+        except (ValueError, KeyError, TypeError, AssertionError) as e:
+            self.send_error(400, explain=str(e))
+            return
+        scheduler.submit(req)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while (tok := req.out.get()) is not None:
+                self.write_chunk({'token': tok, 'text': decode([tok])})
+            if req.error is not None:
+                self.write_chunk({'error': req.error, 'n_tokens': req.n_generated})
+            else:
+                self.write_chunk({'done': True, 'n_tokens': req.n_generated})
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            req.cancelled = True # the scheduler evicts it on its next step
+
+    def write_chunk(self, obj):
+        data = (json.dumps(obj) + '\n').encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass # one line per request is too chatty under load
+
+
+kv_pool = KVPool(model.config, block_len=paged_kv_block, max_blocks=max_kv_blocks or None) if paged_kv_block > 0 else None
+prefix_cache = PrefixCache(model.config, max_bytes=prefix_cache_mb * 2**20) if prefix_cache_mb > 0 else None
+scheduler = Scheduler(model, max_batch_size, kv_pool, prefix_cache)
+scheduler.start()
+server = ThreadingHTTPServer((host, port), Handler)
+print(f"serving {init_from} on http://{host}:{port}/generate, max_batch_size={max_batch_size}")
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
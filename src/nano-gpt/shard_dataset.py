@@ -0,0 +1,48 @@
+"""
+Convert a dataset from the flat train.bin / val.bin layout to fixed-size shards plus a
+manifest.json (see shards.py), in place or into another directory. The copy streams
+chunk_tokens tokens at a time, so it runs in constant memory even for OpenWebText's
+17GB train.bin. Training and evaluation read the manifest in preference to the .bin
+files, so these can be deleted once the conversion is done.
+
+$ python shard_dataset.py --dataset=openwebtext
+$ python shard_dataset.py --dataset=shakespeare_char --shard_tokens=100000 --out_dir=data/shakespeare_char_sharded
+"""
+import os
+import time
+import pickle
+import numpy as np
+from shards import ShardWriter, open_split
+
+# -----------------------------------------------------------------------------
+dataset = 'openwebtext'
+splits = ['train', 'val']
+shard_tokens = 2**27 # 128M tokens, 256MB of uint16 per shard
+chunk_tokens = 2**24 # copied per read / write
+out_dir = '' # '' converts in place, next to the .bin files
+vocab_size = 0 # 0: from the dataset's meta.pkl if there is one, else the gpt2 tokenizer's
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+data_dir = os.path.join('data', dataset)
+out_dir = out_dir or data_dir
+meta = {}
+meta_path = os.path.join(data_dir, 'meta.pkl')
+if os.path.exists(meta_path):
+    with open(meta_path, 'rb') as f:
+        meta = pickle.load(f)
+vocab_size = vocab_size or meta.get('vocab_size', 50257)
+dtype = np.dtype(meta.get('dtype', 'uint16' if vocab_size <= 2**16 else 'uint32')) # as prepare.py wrote the .bin files
+
+for split in splits:
+    t0 = time.time()
+    src = np.memmap(os.path.join(data_dir, f'{split}.bin'), dtype=dtype, mode='r')
+    writer = ShardWriter(out_dir, split, shard_tokens, dtype, vocab_size)
+    for start in range(0, len(src), chunk_tokens):
+        writer.write(src[start:start + chunk_tokens])
+    n = writer.close()
+    print(f"{split}: {n:,} tokens into {len(writer.shards)} shards in {out_dir}, {time.time() - t0:.1f}s")
+    # read back the first and last windows through the manifest
+    check = min(n, 1024)
+    tokens = open_split(out_dir, split)
+    assert (tokens.gather([0, n - check], check) == np.stack([src[:check], src[n - check:]])).all()
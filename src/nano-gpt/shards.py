@@ -0,0 +1,224 @@
+"""
+Token datasets on disk: a split is either one flat .bin file (train.bin / val.bin, as the
+prepare.py scripts write them) or a list of fixed-size .bin shards described by a
+manifest.json next to them:
+
+{
+    "version": 1,
+    "dtype": "uint16",
+    "vocab_size": 50257,
+    "shard_tokens": 134217728,
+    "splits": {
+        "train": {"num_tokens": 9035582198, "shards": [
+            {"file": "train-000000.bin", "num_tokens": 134217728, "offset": 0}, ...]},
+        "val": {...}
+    }
+}
+
+Shard files are looked up relative to the manifest, so shards can be symlinks onto other
+disks. A token is addressed by its global offset in the split. Finding the shard that
+holds it is a binary search over the shard offsets, and a window may straddle two shards.
+
+A manifest can also mix several datasets instead of listing shards:
+
+{"version": 1, "mixture": [{"path": "../openwebtext", "weight": 0.9},
+                           {"path": "../shakespeare", "weight": 0.1}]}
+
+Random windows are then drawn from each dataset in proportion to its weight. Every
+dataset must use the same dtype.
+
+open_split(data_dir, split) returns any of these behind one interface: len() tokens,
+gather(starts, length) windows and random_starts(n, length, generator).
+"""
+
+import os
+import json
+
+import numpy as np
+import torch
+
+MANIFEST = 'manifest.json'
+
+
+class TokenFile:
+    """ One flat .bin file of tokens. """
+
+    def __init__(self, path, dtype=np.uint16):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n_tokens = os.path.getsize(path) // self.dtype.itemsize
+
+    def __len__(self):
+        return self.n_tokens
+
+    def gather(self, starts, length):
+        # (len(starts), length) array of the windows starting at starts, one fancy-indexing op.
+        # a fresh memmap per call, so that the pages read don't pile up in this process, as per
+        # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
+        data = np.memmap(self.path, dtype=self.dtype, mode='r')
+        return data[np.asarray(starts)[:, None] + np.arange(length)]
+
+    def random_starts(self, n, length, generator):
+        return torch.randint(self.n_tokens - length + 1, (n,), generator=generator).numpy()
+
+
+class ShardedTokens(TokenFile):
+    """ The shards of one split of a manifest, addressed as one sequence of tokens. """
+
+    def __init__(self, manifest_path, split):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        assert 'splits' in manifest, f"{manifest_path} is a mixture, use open_split"
+        root = os.path.dirname(manifest_path)
+        info = manifest['splits'][split]
+        self.dtype = np.dtype(manifest['dtype'])
+        self.vocab_size = manifest.get('vocab_size')
+        self.paths = [os.path.join(root, s['file']) for s in info['shards']]
+        self.offsets = [s['offset'] for s in info['shards']] + [info['num_tokens']]
+        self.n_tokens = info['num_tokens']
+        assert self.n_tokens > 0, f"split {split} of {manifest_path} is empty"
+
+    def gather(self, starts, length):
+        starts = np.asarray(starts)
+        out = np.empty((len(starts), length), dtype=self.dtype)
+        shards = np.searchsorted(self.offsets, starts, side='right') - 1  # binary search, O(log n_shards) per window
+        ends = starts + length
+        inside = ends <= np.asarray(self.offsets)[shards + 1]
+        # windows within one shard: one gather per shard touched
+        for i in np.unique(shards[inside]):
+            rows = np.nonzero(inside & (shards == i))[0]
+            data = np.memmap(self.paths[i], dtype=self.dtype, mode='r')
+            out[rows] = data[(starts[rows] - self.offsets[i])[:, None] + np.arange(length)]
+        # windows that straddle shard boundaries: piece by piece
+        for row in np.nonzero(~inside)[0]:
+            pos, i = int(starts[row]), int(shards[row])
+            while pos < ends[row]:
+                n = min(int(ends[row]), self.offsets[i + 1]) - pos
+                data = np.memmap(self.paths[i], dtype=self.dtype, mode='r')
+                done = pos - int(starts[row])
+                out[row, done:done + n] = data[pos - self.offsets[i]:pos - self.offsets[i] + n]
+                pos, i = pos + n, i + 1
+        return out
+
+
+class Mixture:
+    """
+    Several datasets, addressed as their concatenation. Every window comes from a single
+    dataset, picked with probability proportional to its weight.
+    """
+
+    def __init__(self, parts, weights):
+        assert len(parts) == len(weights) and len(parts) > 0
+        assert all(w >= 0 for w in weights) and sum(weights) > 0, "mixture weights must be >= 0 and not all 0"
+        assert len(set(p.dtype for p in parts)) == 1, "every dataset of a mixture must use the same dtype"
+        self.parts = parts
+        self.dtype = parts[0].dtype
+        self.weights = torch.tensor(weights, dtype=torch.float64)
+        self.offsets = [0]
+        for p in parts:
+            self.offsets.append(self.offsets[-1] + len(p))
+        self.n_tokens = self.offsets[-1]
+
+    def __len__(self):
+        return self.n_tokens
+
+    def gather(self, starts, length):
+        starts = np.asarray(starts)
+        out = np.empty((len(starts), length), dtype=self.dtype)
+        parts = np.searchsorted(self.offsets, starts, side='right') - 1
+        for i in np.unique(parts):
+            rows = np.nonzero(parts == i)[0]
+            assert (starts[rows] + length <= self.offsets[i + 1]).all(), "windows can't span two datasets of a mixture"
+            out[rows] = self.parts[i].gather(starts[rows] - self.offsets[i], length)
+        return out
+
+    def random_starts(self, n, length, generator):
+        parts = torch.multinomial(self.weights, n, replacement=True, generator=generator).numpy()
+        starts = np.empty(n, dtype=np.int64)
+        for i in np.unique(parts):
+            rows = np.nonzero(parts == i)[0]
+            starts[rows] = self.parts[i].random_starts(len(rows), length, generator) + self.offsets[i]
+        return starts
+
+
+def open_split(data_dir, split, dtype=np.uint16):
+    """
+    The tokens of one split of the dataset in data_dir: its manifest.json if there is
+    one (shards or a mixture), else the flat {split}.bin of the given dtype.
+    """
+    manifest_path = os.path.join(data_dir, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return TokenFile(os.path.join(data_dir, f'{split}.bin'), dtype)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if 'mixture' not in manifest:
+        return ShardedTokens(manifest_path, split)
+    parts = [open_split(os.path.join(data_dir, m['path']), split, dtype) for m in manifest['mixture']]
+    return Mixture(parts, [m['weight'] for m in manifest['mixture']])
+
+
+class ShardWriter:
+    """
+    Appends tokens to the shards of one split, starting a new shard file every shard_tokens
+    tokens. close() records the split in out_dir/manifest.json, keeping the other splits.
+    """
+
+    def __init__(self, out_dir, split, shard_tokens, dtype=np.uint16, vocab_size=None):
+        self.out_dir = out_dir
+        self.split = split
+        self.shard_tokens = shard_tokens
+        self.dtype = np.dtype(dtype)
+        self.vocab_size = vocab_size
+        self.shards = []  # manifest entries of the shards written so far
+        self.file = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, ids):
+        ids = np.asarray(ids, dtype=self.dtype)
+        while len(ids) > 0:
+            if self.file is None or self.shards[-1]['num_tokens'] == self.shard_tokens:
+                self._next_shard()
+            n = min(len(ids), self.shard_tokens - self.shards[-1]['num_tokens'])
+            self.file.write(ids[:n].tobytes())
+            self.shards[-1]['num_tokens'] += n
+            ids = ids[n:]
+
+    def _next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        name = f'{self.split}-{len(self.shards):06d}.bin'
+        offset = self.shards[-1]['offset'] + self.shards[-1]['num_tokens'] if self.shards else 0
+        self.shards.append({'file': name, 'num_tokens': 0, 'offset': offset})
+        self.file = open(os.path.join(self.out_dir, name), 'wb')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return write_manifest(self.out_dir, self.split, self.shards, self.dtype, self.vocab_size, self.shard_tokens)
+
+
+def write_manifest(out_dir, split, shards, dtype, vocab_size, shard_tokens):
+    """
+    Record split in out_dir/manifest.json as the given shards, a list of {'file', 'num_tokens'}
+    in order (their offsets are filled in), keeping the other splits. Returns the split's tokens.
+    """
+    dtype = np.dtype(dtype)
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    manifest = {'version': 1, 'splits': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        assert 'mixture' not in manifest, f"{manifest_path} is a mixture"
+        assert manifest['dtype'] == dtype.name, f"{manifest_path} holds {manifest['dtype']} tokens"
+    manifest.update(dtype=dtype.name, vocab_size=vocab_size, shard_tokens=shard_tokens)
+    num_tokens = 0
+    for shard in shards:
+        shard['offset'] = num_tokens
+        num_tokens += shard['num_tokens']
+    manifest['splits'][split] = {'num_tokens': num_tokens, 'shards': shards}
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)  # the manifest only ever lists shards that are complete
+    return num_tokens
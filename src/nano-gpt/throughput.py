@@ -0,0 +1,135 @@
+"""
+Throughput and model FLOPs utilization (MFU) on whatever hardware we run on.
+- PEAK_FLOPS: the dense peak FLOPS of known GPUs per compute dtype, from the datasheets
+- calibrate(): the achievable peak of the current device, measured with a quick matmul
+  (the only option on a CPU or a GPU missing from the table)
+- flops_per_token(): the exact matmul FLOPs of the model per token of a sequence of the
+  actual length, counting only the causal half of attention, forward or forward + backward
+- Throughput: tokens/sec, samples/sec, achieved TFLOPS and MFU of a timed step
+
+MFU counts model FLOPs, the ones the math needs. Recomputed activations
+(GPTConfig.recompute) cost time but don't count, so they show up as a lower MFU.
+"""
+
+import time
+
+import torch
+
+# dense (no sparsity) peak FLOPS by device name and compute dtype. 'tf32' is what float32
+# matmuls run at on Ampere and newer with torch.backends.cuda.matmul.allow_tf32 = True.
+# longer names first, so that e.g. 'H100 PCIe' wins over 'H100'
+PEAK_FLOPS = {
+    'H100 PCIe': {'float32': 51e12, 'tf32': 378e12, 'bfloat16': 756e12, 'float16': 756e12},
+    'H100': {'float32': 67e12, 'tf32': 495e12, 'bfloat16': 989e12, 'float16': 989e12},
+    'A100': {'float32': 19.5e12, 'tf32': 156e12, 'bfloat16': 312e12, 'float16': 312e12},
+    'L40S': {'float32': 91.6e12, 'tf32': 183e12, 'bfloat16': 362e12, 'float16': 362e12},
+    'L4': {'float32': 30.3e12, 'tf32': 60e12, 'bfloat16': 121e12, 'float16': 121e12},
+    'A10': {'float32': 31.2e12, 'tf32': 62.5e12, 'bfloat16': 125e12, 'float16': 125e12},
+    'RTX 4090': {'float32': 82.6e12, 'tf32': 82.6e12, 'bfloat16': 165e12, 'float16': 165e12},
+    'RTX 3090': {'float32': 35.6e12, 'tf32': 35.6e12, 'bfloat16': 71e12, 'float16': 71e12},
+    'V100': {'float32': 15.7e12, 'float16': 125e12},
+    'T4': {'float32': 8.1e12, 'float16': 65e12},
+}
+
+_calibrated = {}  # (device, dtype) -> measured FLOPS, calibrate once per process
+
+
+def _compute_dtype(device, dtype):
+    # the name of the dtype matmuls actually run in
+    if dtype == 'float32' and 'cuda' in str(device) and torch.backends.cuda.matmul.allow_tf32:
+        return 'tf32'
+    return dtype
+
+
+def table_peak_flops(device, dtype):
+    # peak FLOPS of device for dtype from PEAK_FLOPS, None if unknown
+    if 'cuda' not in str(device) or not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name(torch.device(device))
+    dtype = _compute_dtype(device, dtype)
+    for key in sorted(PEAK_FLOPS, key=len, reverse=True):
+        if key in name:
+            return PEAK_FLOPS[key].get(dtype)
+    return None
+
+
+def calibrate(device, dtype, n=0, iters=10):
+    """
+    The FLOPS of an n x n matmul in dtype on device, i.e. the achievable peak of this host.
+    n defaults to 4096 on cuda and 1024 elsewhere. Takes well under a second on a GPU.
+    """
+    key = (str(device), dtype)
+    if key not in _calibrated:
+        cuda = 'cuda' in str(device)
+        n = n or (4096 if cuda else 1024)
+        ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+        a = torch.randn(n, n, device=device, dtype=ptdtype)
+        b = torch.randn(n, n, device=device, dtype=ptdtype)
+        for _ in range(2):  # warmup
+            a @ b
+        if cuda:
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            a @ b
+        if cuda:
+            torch.cuda.synchronize()
+        _calibrated[key] = 2 * n**3 * iters / (time.perf_counter() - t0)
+    return _calibrated[key]
+
+
+def peak_flops(device, dtype, measure=False):
+    """
+    (FLOPS, source) to measure MFU against: the table's peak for known GPUs, else (or with
+    measure=True) the calibrated matmul FLOPS of this device.
+    """
+    flops = None if measure else table_peak_flops(device, dtype)
+    if flops is not None:
+        return flops, 'table'
+    return calibrate(device, dtype), 'calibrated'
+
+
+def flops_per_token(config, seq_len, training=True):
+    """
+    Matmul FLOPs of the model per token, averaged over a sequence of seq_len tokens.
+    2 FLOPs per multiply-add. Attention is causal, so position t attends to t + 1 keys,
+    (seq_len + 1) / 2 on average. Backward costs twice the forward.
+    """
+    C, L, V = config.n_embd, config.n_layer, config.vocab_size
+    kv_dim = C * (config.n_kv_head or config.n_head) // config.n_head
+    per_layer = 2 * C * (C + 2 * kv_dim)  # q, k, v projections
+    per_layer += 2 * C * (seq_len + 1)  # q @ k^T and att @ v, over (seq_len + 1) / 2 keys each
+    per_layer += 2 * C * C  # attention output projection
+    per_layer += 2 * 2 * C * 4 * C  # mlp
+    forward = L * per_layer + 2 * C * V  # + lm_head
+    return 3 * forward if training else forward
+
+
+class Throughput:
+    """
+    Throughput of steps of a model with the given config on device, computing in dtype
+    ('float32', 'bfloat16' or 'float16'). world_size: ranks running such steps in parallel,
+    tokens/sec and samples/sec are for all of them together, MFU is per device.
+    """
+
+    def __init__(self, config, device, dtype, world_size=1, measure_peak=False):
+        self.config = config
+        self.world_size = world_size
+        self.peak, self.peak_source = peak_flops(device, dtype, measure_peak)
+
+    def __call__(self, samples, seq_len, dt, training=True):
+        """
+        Stats of one rank processing samples sequences of seq_len tokens in dt seconds:
+        {'tokens/sec', 'samples/sec', 'tflops', 'mfu'}.
+        """
+        tokens = samples * seq_len
+        flops = flops_per_token(self.config, seq_len, training) * tokens / dt
+        return {
+            'tokens/sec': tokens * self.world_size / dt,
+            'samples/sec': samples * self.world_size / dt,
+            'tflops': flops / 1e12,
+            'mfu': flops / self.peak,
+        }
+
+    def describe(self):
+        return f"MFU relative to {self.peak / 1e12:.1f} TFLOPS ({self.peak_source})"
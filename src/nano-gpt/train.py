@@ -28,6 +28,13 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from weights import load_checkpoint, peak_rss
+from checkpointing import CheckpointWriter
+from dataloader import DataLoader, EpochSampler, EvalSet
+from shards import open_split, Mixture
+from metrics import Metrics
+from profiler import StepProfiler
+from throughput import Throughput
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -35,9 +42,16 @@ from model import GPTConfig, GPT
 out_dir = 'out'
 eval_interval = 2000
 log_interval = 1
-eval_iters = 200
+profile = False # if True, time every phase of every iteration (host wall and device time), with a table every profile_interval iters
+profile_interval = 100
+profile_trace = '' # iteration ranges to capture with torch.profiler as Chrome traces in out_dir, e.g. '10:15,2000:2005'
+eval_iters = 200 # the eval set is eval_iters * batch_size windows per split, split across the DDP ranks
+eval_batch_size = 0 # micro-batch size for evaluation, which keeps no activations for backward; 0 means 2 * batch_size
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+ckpt_async = True # write checkpoints on a background thread, training only waits for the copy to cpu memory
+ckpt_keep_last = 1 # keep the last N checkpoints as ckpt-<iter>.pt, ckpt.pt always links to the newest
+ckpt_shard = False # with DDP, every rank writes its share of the model and optimizer state in parallel
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
 # wandb logging
 wandb_log = True # enabled for tracking
@@ -49,12 +63,18 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8 # used to simulate larger batch sizes
 batch_size = 12 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+data_prefetch = 2 # number of batches the background data loader keeps ready
 # model
 n_layer = 12
 n_head = 12
+n_kv_head = 0 # key/value heads for grouped-query attention, 1 is multi-query; 0 means n_head (standard attention)
 n_embd = 768
 dropout = 0.0 # for pretraining 0 is good, for finetuning try 0.1+
 bias = False # do we use bias inside LayerNorm and Linear layers?
+loss_chunk_size = 0 # if > 0, fuse lm_head + cross-entropy over chunks of this many positions, never materializing the full logits
+recompute = '' # activation checkpointing: '' (off), 'block', 'attn' or 'mlp' activations are recomputed in the backward pass
+recompute_every = 1 # only recompute in every Nth block
+recompute_sweep = False # if True, print peak memory and step time of every recompute policy before training
 # adamw optimizer
 learning_rate = 6e-4 # max learning rate
 max_iters = 600000 # total number of training iterations
@@ -67,6 +87,7 @@ decay_lr = True # whether to decay the learning rate
 warmup_iters = 2000 # how many steps to warm up for
 lr_decay_iters = 600000 # should be ~= max_iters per Chinchilla
 min_lr = 6e-5 # minimum learning rate, should be ~= learning_rate/10 per Chinchilla
+mfu_calibrate = False # measure MFU against this device's measured matmul FLOPS, not its datasheet peak (always done if it isn't in throughput.PEAK_FLOPS)
 # DDP settings
 backend = 'nccl' # 'nccl', 'gloo', etc.
 # system
@@ -112,24 +133,7 @@ device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.aut
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-# poor man's data loader
 data_dir = os.path.join('data', dataset)
-def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
-    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -138,15 +142,19 @@ best_val_loss = 1e9
 # attempt to derive vocab_size from the dataset
 meta_path = os.path.join(data_dir, 'meta.pkl')
 meta_vocab_size = None
+data_dtype = np.uint16 # of the token ids in the .bin files
 if os.path.exists(meta_path):
     with open(meta_path, 'rb') as f:
         meta = pickle.load(f)
     meta_vocab_size = meta['vocab_size']
+    data_dtype = np.dtype(meta.get('dtype', 'uint16')) # older meta.pkl files don't record it
     print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
 
 # model init
-model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
-                  bias=bias, vocab_size=None, dropout=dropout) # start with model_args from command line
+t_load = time.time()
+model_args = dict(n_layer=n_layer, n_head=n_head, n_kv_head=n_kv_head, n_embd=n_embd, block_size=block_size,
+                  bias=bias, vocab_size=None, dropout=dropout, loss_chunk_size=loss_chunk_size,
+                  recompute=recompute, recompute_every=recompute_every) # start with model_args from command line
 if init_from == 'scratch':
     # init a new model from scratch
     print("Initializing a new model from scratch")
@@ -160,38 +168,39 @@ elif init_from == 'resume':
     print(f"Resuming training from {out_dir}")
     # resume training from a checkpoint.
     ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
+    checkpoint = load_checkpoint(ckpt_path) # memory-mapped, on the cpu until the model is moved
     checkpoint_model_args = checkpoint['model_args']
     # force these config attributes to be equal otherwise we can't even resume training
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = checkpoint_model_args[k]
-    # create the model
+    model_args['n_kv_head'] = checkpoint_model_args.get('n_kv_head', 0) # older checkpoints predate GQA
+    # create the model straight from the checkpoint weights, skipping the random init
     gptconf = GPTConfig(**model_args)
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    # fix the keys of the state dictionary :(
-    # honestly no idea how checkpoints sometimes get this prefix, have to debug more
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model = GPT.from_state_dict(gptconf, checkpoint['model'])
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
 elif init_from.startswith('gpt2'):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
     # initialize from OpenAI GPT-2 weights
-    override_args = dict(dropout=dropout)
+    override_args = dict(dropout=dropout, loss_chunk_size=loss_chunk_size,
+                         recompute=recompute, recompute_every=recompute_every)
     model = GPT.from_pretrained(init_from, override_args)
     # read off the created config params, so we can store them into checkpoint correctly
-    for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
+    for k in ['n_layer', 'n_head', 'n_kv_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = getattr(model.config, k)
+    # uptrain gpt2 with grouped-query attention, starting from its mean-pooled key/value heads
+    if n_kv_head and n_kv_head != model.config.n_head:
+        print(f"grouping the {model.config.n_head} key/value heads into {n_kv_head}")
+        model.group_kv_heads(n_kv_head)
+        model_args['n_kv_head'] = n_kv_head
 # crop down the model block size if desired, using model surgery
 if block_size < model.config.block_size:
     model.crop_block_size(block_size)
     model_args['block_size'] = block_size # so that the checkpoint will have the right value
 model.to(device)
+if init_from != 'scratch':
+    print(f"loaded the weights in {time.time() - t_load:.2f}s, peak RSS {peak_rss() / 2**30:.2f}GiB")
 
 # initialize a GradScaler. If enabled=False scaler is a no-op
 scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
@@ -200,8 +209,28 @@ scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
 optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
 if init_from == 'resume':
     optimizer.load_state_dict(checkpoint['optimizer'])
+sampler_state = checkpoint.get('sampler') if init_from == 'resume' else None # older checkpoints don't have it
 checkpoint = None # free up memory
 
+# data loaders, prefetching their batches on background threads. training walks through
+# non-overlapping windows without replacement, each rank through its own share of every
+# epoch, and picks up where the checkpoint left off. a weighted mixture of datasets is
+# sampled at random by its weights instead. evaluation scores a fixed set of windows per
+# split, drawn once up front, and never disturbs the training order
+splits = {split: open_split(data_dir, split, data_dtype) for split in ['train', 'val']}
+sampler = None
+if not isinstance(splits['train'], Mixture):
+    sampler = EpochSampler(len(splits['train']), block_size, batch_size,
+                           rank=ddp_rank if ddp else 0, num_replicas=ddp_world_size)
+    if sampler_state is not None:
+        sampler.load_state_dict(sampler_state)
+        print(f"resuming the data order at epoch {sampler.epoch}, step {sampler.step}/{sampler.steps_per_epoch}")
+train_loader = DataLoader(splits['train'], batch_size, block_size, device, prefetch=data_prefetch,
+                          seed=1337 + seed_offset, sampler=sampler)
+eval_sets = {split: EvalSet(splits[split], eval_iters * batch_size, block_size, seed=1337 + 1000 * (k + 1))
+             for k, split in enumerate(['train', 'val'])}
+eval_batch_size = eval_batch_size or 2 * batch_size
+
 # compile the model
 if compile:
     print("compiling the model... (takes a ~minute)")
@@ -212,21 +241,24 @@ if compile:
 if ddp:
     model = DDP(model, device_ids=[ddp_local_rank])
 
-# helps estimate an arbitrarily accurate loss over either split using many batches
+# helps estimate an arbitrarily accurate loss over either split using many batches.
+# every rank scores its share of the eval set and the sums are all-reduced, so all ranks
+# get the same numbers. this runs the unwrapped model: the ranks may run different
+# numbers of batches, and DDP's forward would wait on the other ranks
 @torch.no_grad()
 def estimate_loss():
-    out = {}
-    model.eval()
-    for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y = get_batch(split)
+    raw_model.eval()
+    totals = torch.zeros(len(eval_sets), 2, device=device) # per split: sum of the per-window losses, number of windows
+    for k, eval_set in enumerate(eval_sets.values()):
+        for X, Y in eval_set.batches(eval_batch_size, device, ddp_rank if ddp else 0, ddp_world_size):
             with ctx:
-                logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
-    model.train()
-    return out
+                logits, loss = raw_model(X, Y)
+            totals[k, 0] += loss.float() * X.size(0)
+            totals[k, 1] += X.size(0)
+    if ddp:
+        torch.distributed.all_reduce(totals)
+    raw_model.train()
+    return dict(zip(eval_sets, (totals[:, 0] / totals[:, 1]).tolist())) # the one sync of the whole eval
 
 # learning rate decay scheduler (cosine with warmup)
 def get_lr(it):
@@ -254,49 +286,111 @@ if wandb_log and master_process:
         config=wandb_config,
     )
 
+raw_model = model.module if ddp else model # unwrap DDP container if needed
+compute_dtype = 'float32' if device_type == 'cpu' else dtype # no autocast on cpu, see ctx
+throughput = Throughput(raw_model.config, device, compute_dtype, ddp_world_size, measure_peak=mfu_calibrate)
+if master_process:
+    print(throughput.describe())
+ckpt_writer = CheckpointWriter(out_dir, keep_last=ckpt_keep_last, shard=ckpt_shard, rank=ddp_rank if ddp else 0,
+                               world_size=ddp_world_size, async_save=ckpt_async)
+
+# peak memory vs step time of one micro-batch forward + backward under every recompute policy,
+# to pick the one with the most tokens/sec that still fits (run without DDP gradient syncs)
+def recompute_tradeoff(steps=3):
+    X, Y = next(eval_sets['train'].batches(batch_size, device))
+    policies = [('', 1), ('block', 1), ('block', 2), ('block', 4), ('attn', 1), ('mlp', 1)]
+    print(f"{'recompute':>12} {'every':>6} {'peak mem':>12} {'step time':>12} {'tokens/sec':>12} {'mfu':>8}")
+    for policy, every in policies:
+        raw_model.config.recompute, raw_model.config.recompute_every = policy, every
+        for k in range(steps + 1): # the first step is a warmup, e.g. for torch.compile
+            if k == 1:
+                if device_type == 'cuda':
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                t0 = time.time()
+            with ctx:
+                logits, loss = raw_model(X, Y)
+            scaler.scale(loss).backward()
+            optimizer.zero_grad(set_to_none=True)
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
+        dt = (time.time() - t0) / steps
+        mem = f"{torch.cuda.max_memory_allocated() / 2**30:.2f}GiB" if device_type == 'cuda' else 'n/a'
+        tp = throughput(batch_size, block_size, dt)
+        print(f"{policy or 'off':>12} {every:>6} {mem:>12} {dt*1000:>10.1f}ms {tp['tokens/sec'] / ddp_world_size:>12.0f} {tp['mfu']*100:>7.2f}%")
+    raw_model.config.recompute, raw_model.config.recompute_every = recompute, recompute_every
+
+if recompute_sweep and master_process:
+    recompute_tradeoff()
+
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+X, Y = train_loader.next() # fetch the very first batch
 t0 = time.time()
 local_iter_num = 0 # number of iterations in the lifetime of this process
-raw_model = model.module if ddp else model # unwrap DDP container if needed
 running_mfu = -1.0
+metrics = Metrics(device) # loss and grad norm, summed on the device and fetched without a sync
+profiler = StepProfiler(device, profile, profile_trace, out_dir, rank=ddp_rank if ddp else 0)
+
+def log_metrics(it, m):
+    global running_mfu
+    tp = throughput(batch_size * gradient_accumulation_steps, block_size, m['dt']) # this rank's samples of the iteration
+    if m['local_iter_num'] >= 5: # let the training loop settle a bit
+        running_mfu = tp['mfu'] if running_mfu == -1.0 else 0.9*running_mfu + 0.1*tp['mfu']
+    grad = f", grad norm {m['grad_norm']:.2f} (max {m['grad_norm_max']:.2f}, {m['clipped']*100:.0f}% clipped)" if 'grad_norm' in m else ''
+    # tokens since the last log and their rate over that wall time, of all ranks
+    print(f"iter {it}: loss {m['loss']:.4f}{grad}, time {m['dt']*1000:.2f}ms, data wait {m['data_wait']*1000:.2f}ms, "
+          f"{m['tokens'] * ddp_world_size:,} tokens at {m['tokens/sec'] * ddp_world_size:.0f} tokens/sec, "
+          f"{tp['samples/sec']:.1f} samples/sec, mfu {running_mfu*100:.2f}%")
 while True:
+    profiler.step(iter_num)
 
     # determine and set the learning rate for this iteration
     lr = get_lr(iter_num) if decay_lr else learning_rate
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
 
-    # evaluate the loss on train/val sets and write checkpoints
-    if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-        if wandb_log:
-            wandb.log({
-                "iter": iter_num,
-                "train/loss": losses['train'],
-                "val/loss": losses['val'],
-                "lr": lr,
-                "mfu": running_mfu*100, # convert to percentage
-            })
+    # evaluate the loss on train/val sets and write checkpoints. every rank takes part
+    # and gets the same losses, so they all agree on whether to save a checkpoint
+    if iter_num % eval_interval == 0:
+        t_eval = time.time()
+        with profiler.phase('eval'):
+            losses = estimate_loss()
+        if master_process:
+            print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}, "
+                  f"eval time {time.time() - t_eval:.2f}s")
+            if wandb_log:
+                wandb.log({
+                    "iter": iter_num,
+                    "train/loss": losses['train'],
+                    "val/loss": losses['val'],
+                    "lr": lr,
+                    "mfu": running_mfu*100, # convert to percentage
+                })
+        save_checkpoint = False
         if losses['val'] < best_val_loss or always_save_checkpoint:
             best_val_loss = losses['val']
-            if iter_num > 0:
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'model_args': model_args,
-                    'iter_num': iter_num,
-                    'best_val_loss': best_val_loss,
-                    'config': config,
-                }
+            save_checkpoint = iter_num > 0
+        if save_checkpoint: # without ckpt_shard, CheckpointWriter.save is a no-op on all ranks but 0
+            checkpoint = {
+                'model': raw_model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'model_args': model_args,
+                'iter_num': iter_num,
+                'best_val_loss': best_val_loss,
+                'config': config,
+                'sampler': train_loader.state_dict(),
+            }
+            if master_process:
                 print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+            with profiler.phase('checkpoint'):
+                ckpt_writer.save(checkpoint, iter_num)
+            checkpoint = None
     if iter_num == 0 and eval_only:
         break
 
     # forward backward update, with optional gradient accumulation to simulate larger batch size
     # and using the GradScaler if data type is float16
+    train_loader.pop_wait_time() # only count the waits of this iteration's micro steps
     for micro_step in range(gradient_accumulation_steps):
         if ddp:
             # in DDP training we only need to sync gradients at the last micro step.
@@ -304,35 +398,54 @@ while True:
             # I really dislike that this bloats the code and forces us to repeat code
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-        with ctx:
+        with profiler.phase('forward'), ctx:
             logits, loss = model(X, Y)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
+            metrics.add('loss', loss) # the scaled micro step losses add up to the iteration's mean loss
+        metrics.count('tokens', X.numel())
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
-        # backward pass, with gradient scaling if training in fp16
-        scaler.scale(loss).backward()
+        with profiler.phase('data'):
+            X, Y = train_loader.next()
+        # backward pass, with gradient scaling if training in fp16. with DDP the gradients are
+        # all-reduced during the last micro step's backward, the difference to the others is the sync
+        with profiler.phase('backward_sync' if ddp and model.require_backward_grad_sync else 'backward'):
+            scaler.scale(loss).backward()
+    data_wait = train_loader.pop_wait_time()
     # clip the gradient
     if grad_clip != 0.0:
-        scaler.unscale_(optimizer)
-        torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+        with profiler.phase('clip'):
+            scaler.unscale_(optimizer)
+            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip) # the norm before clipping
+            metrics.add('grad_norm', grad_norm)
+            metrics.maximum('grad_norm', grad_norm)
+            metrics.add('clipped', (grad_norm > grad_clip).float())
     # step the optimizer and scaler if training in fp16
-    scaler.step(optimizer)
-    scaler.update()
-    # flush the gradients as soon as we can, no need for this memory anymore
-    optimizer.zero_grad(set_to_none=True)
+    with profiler.phase('optimizer'):
+        scaler.step(optimizer)
+        scaler.update()
+        # flush the gradients as soon as we can, no need for this memory anymore
+        optimizer.zero_grad(set_to_none=True)
 
     # timing and logging
     t1 = time.time()
     dt = t1 - t0
     t0 = t1
-    if iter_num % log_interval == 0 and master_process:
-        # get loss as float. note: this is a CPU-GPU sync point
-        # scale up to undo the division above, approximating the true total loss (exact would have been a sum)
-        lossf = loss.item() * gradient_accumulation_steps
-        if local_iter_num >= 5: # let the training loop settle a bit
-            mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
-            running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+    metrics.step()
+    if iter_num % log_interval == 0:
+        # the loss and grad norm averaged over the iterations since the last log. this only
+        # starts their copy to the host, they are printed once it has landed (no CPU-GPU sync)
+        metrics.flush(iter_num, dt=dt, data_wait=data_wait, local_iter_num=local_iter_num)
+    for it, m in metrics.ready():
+        if master_process:
+            log_metrics(it, m)
+    if profile and local_iter_num > 0 and iter_num % profile_interval == 0:
+        # where the time of the last profile_interval iterations went, to see which phase
+        # regressed when the mfu drops. waits for the device, which is fine when profiling
+        table, stats = profiler.report()
+        if master_process:
+            print(f"iter {iter_num}: time per phase\n{table}")
+            if wandb_log:
+                wandb.log({"iter": iter_num, **stats})
     iter_num += 1
     local_iter_num += 1
 
@@ -340,5 +453,10 @@ while True:
     if iter_num > max_iters:
         break
 
+for it, m in metrics.ready(wait=True):
+    if master_process:
+        log_metrics(it, m)
+profiler.close()
+ckpt_writer.wait() # don't exit with a checkpoint half written
 if ddp:
     destroy_process_group()
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""
+Loading model weights without copying them.
+A .safetensors file is a small JSON header followed by the raw bytes of every tensor, so
+load_safetensors maps the file into memory and hands out tensors that view it directly:
+nothing is read until a tensor is touched, and nothing is copied unless it is written to.
+GPT-2 weights are converted to the nanoGPT layout (Conv1D weights transposed, the unused
+attention buffers dropped) once, into a safetensors file in cache_dir, and memory-mapped
+from there on every later load. No transformers GPT2LMHeadModel is ever built.
+"""
+
+import os
+import sys
+import json
+import mmap
+import inspect
+import resource
+
+import torch
+
+from checkpointing import shard_path
+
+_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+_NAMES = {v: k for k, v in _DTYPES.items()}
+
+# the openai checkpoints use a "Conv1D" module, which stores these weights transposed to a vanilla Linear
+CONV1D_WEIGHTS = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
+
+
+def load_safetensors(path):
+    """
+    Tensors of a .safetensors file as a dict of CPU tensors backed by a copy-on-write mmap
+    of the file, plus the file's metadata dict.
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)  # private: writes never reach the file
+    n = int.from_bytes(buf[:8], 'little')
+    header = json.loads(buf[8:8 + n])
+    metadata = header.pop('__metadata__', {})
+    tensors = {}
+    for name, info in header.items():
+        dtype = _DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        if start == end:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(buf, dtype=dtype, count=count, offset=8 + n + start).view(info['shape'])
+    return tensors, metadata
+
+
+def save_safetensors(tensors, path, metadata=None):
+    """
+    Write a dict of tensors to a .safetensors file, one tensor at a time so that lazily
+    transformed views (e.g. transposes) are only materialized one by one. The file is
+    written next to path and renamed into place, so path is never left half written.
+    """
+    header, offset = {}, 0
+    for name, t in tensors.items():
+        size = t.numel() * t.element_size()
+        header[name] = dict(dtype=_NAMES[t.dtype], shape=list(t.shape), data_offsets=[offset, offset + size])
+        offset += size
+    if metadata:
+        header['__metadata__'] = {k: str(v) for k, v in metadata.items()}
+    header = json.dumps(header).encode()
+    header += b' ' * (-len(header) % 8)  # keep the tensor data 8-byte aligned
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for t in tensors.values():
+            if t.numel() > 0:
+                f.write(t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+    os.replace(tmp_path, path)
+
+
+def gpt2_state_dict(model_type, cache_dir=None):
+    """
+    The nanoGPT state_dict of a pretrained GPT-2, memory-mapped from cache_dir (by default
+    ~/.cache/nanogpt). The first call downloads the Hugging Face safetensors file and
+    converts it. lm_head.weight is tied to transformer.wte.weight and not included.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'nanogpt')
+    path = os.path.join(cache_dir, f'{model_type}.safetensors')
+    if not os.path.exists(path):
+        from huggingface_hub import hf_hub_download
+        print(f"converting {model_type} to the nanoGPT layout, once, into {path}")
+        sd_hf, _ = load_safetensors(hf_hub_download(model_type, 'model.safetensors'))
+        sd = {}
+        for k, v in sd_hf.items():
+            k = k.removeprefix('transformer.')
+            if k.endswith('.attn.bias') or k.endswith('.attn.masked_bias') or k.startswith('lm_head.'):
+                continue  # the causal mask buffers, and the head that is tied to wte anyway
+            sd['transformer.' + k] = v.t() if any(k.endswith(w) for w in CONV1D_WEIGHTS) else v
+        os.makedirs(cache_dir, exist_ok=True)
+        save_safetensors(sd, path, dict(model_type=model_type))
+    sd, _ = load_safetensors(path)
+    return sd
+
+
+def _torch_load(path):
+    # onto the CPU, with the tensors memory-mapped instead of read up front where torch supports it (>= 2.1)
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location='cpu', mmap=True)
+    return torch.load(path, map_location='cpu')
+
+
+def load_checkpoint(path):
+    """
+    torch.load a ckpt.pt onto the CPU. A checkpoint that CheckpointWriter sharded across
+    ranks is put back together from the shards next to it.
+    """
+    checkpoint = _torch_load(path)
+    for rank in range(1, checkpoint.pop('num_shards', 1)):
+        shard = _torch_load(shard_path(os.path.dirname(path), checkpoint['shard_stem'], rank))
+        checkpoint['model'].update(shard['model'])
+        checkpoint['optimizer']['state'].update(shard['optimizer']['state'])
+    checkpoint.pop('shard_stem', None)
+    return checkpoint
+
+
+def peak_rss():
+    # peak resident set size of this process so far, in bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # linux reports kilobytes